@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# Times the update cycle's database access patterns against a synthetic
+# SQLite database, with and without the indexes from model/db.py.
+#
+#   python -m bench.db_queries [rows]
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from eveposcal.app import app, db
+from eveposcal.model import db as db_model
+from eveposcal.model.db import CalendarEvent, EnabledTowers, Settings, Token
+
+TOWERS_PER_CHAR = 10
+ORBITS = 50000
+SAMPLE = 500
+
+
+def timed(label, fn, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+        db.session.remove()
+    print('  %-40s %8.2f ms' % (label, best * 1000))
+
+
+def populate(rows):
+    chars = rows // TOWERS_PER_CHAR
+    enabled = [{'char_id': c, 'orbit_id': 40000000 + (c * TOWERS_PER_CHAR + i) % ORBITS}
+               for c in range(chars) for i in range(TOWERS_PER_CHAR)]
+    db.session.execute(EnabledTowers.__table__.insert(), enabled)
+    db.session.execute(CalendarEvent.__table__.insert(),
+                       [dict(row, event_id='evt%d' % (n,),
+                             reminder_s=CalendarEvent.LEGACY_REMINDER_S)
+                        for n, row in enumerate(enabled)])
+    db.session.execute(Settings.__table__.insert(),
+                       [{'char_id': c, 'key': key, 'value': 'value%d' % (c,)}
+                        for c in range(chars) for key in (Settings.CALENDAR, Settings.SYNC_TOKEN)])
+    db.session.execute(Token.__table__.insert(),
+                       [{'char_id': c, 'kind': Token.GOOGLE_OAUTH, 'value': b'{}'}
+                        for c in range(chars)])
+    db.session.commit()
+    return chars
+
+
+def run_queries(sample):
+    timed('distinct char_ids (full scan)',
+          lambda: set(e.char_id for e in EnabledTowers.query.all()))
+    timed('distinct char_ids (SELECT DISTINCT)', EnabledTowers.get_char_ids)
+    timed('distinct orbit_ids (SELECT DISTINCT)', EnabledTowers.get_orbit_ids)
+    timed('Settings.multiget', lambda: Settings.multiget(sample, Settings.CALENDAR))
+    timed('Token by kind, char_id IN',
+          lambda: Token.query.filter(Token.kind == Token.GOOGLE_OAUTH,
+                                     Token.char_id.in_(sample)).all())
+    timed('CalendarEvent.get_for_chars', lambda: CalendarEvent.get_for_chars(sample))
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tmp_dir, 'bench.db')
+        db.create_all()
+        chars = populate(rows)
+        sample = random.sample(range(chars), min(SAMPLE, chars))
+        print('%d enabled towers, %d characters, %d characters per lookup' % (
+            rows, chars, len(sample)))
+
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.drop(db.engine)
+        print('without indexes:')
+        run_queries(sample)
+
+        db_model.upgrade_schema()
+        print('with indexes (after upgrade_schema):')
+        run_queries(sample)
+    finally:
+        db.session.remove()
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
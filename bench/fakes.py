@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# Local stand-ins for the posmon feed and the parts of Google Calendar v3
+# (discovery, calendars, events and batch) that CalendarService uses.
+#
+#   python -m bench.fakes [--towers N] [--latency S] [--error-rate P]
+#
+# Prints {"posmon": port, "calendar": port} once both are listening. Besides
+# the APIs, the calendar server reports call counts at GET /stats (POST
+# resets them), and POST /advance?fraction=F to the posmon server refuels a
+# random fraction of the towers.
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import argparse
+import email.parser
+import gevent
+import itertools
+import json
+import random
+import re
+import sys
+import urlparse
+from collections import defaultdict
+from datetime import datetime
+from gevent.pywsgi import WSGIServer
+
+TOWERS_PER_CORP = 50
+ORBIT_BASE = 40000000
+PAGE_SIZE = 250
+
+STATUS_TEXT = {200: 'OK', 204: 'No Content', 304: 'Not Modified', 403: 'Forbidden',
+               404: 'Not Found', 410: 'Gone', 503: 'Service Unavailable'}
+
+
+def _respond(start_response, status, body='', content_type='application/json', headers=()):
+    start_response('%d %s' % (status, STATUS_TEXT[status]),
+                   [('Content-Type', content_type)] + list(headers))
+    return [body]
+
+
+class PosmonFeed(object):
+    def __init__(self, towers, seed=0):
+        self._random = random.Random(seed)
+        self._generation = 0
+        now = datetime.utcnow().replace(microsecond=0)
+        self._corps = []
+        for corp_start in xrange(0, towers, TOWERS_PER_CORP):
+            corp = {'corporation': {'id': 98000000 + corp_start, 'name': 'Corp %d' % corp_start},
+                    'cache_ts': now,
+                    'towers': []}
+            for i in xrange(corp_start, min(corp_start + TOWERS_PER_CORP, towers)):
+                corp['towers'].append({
+                    'name': 'Tower %d' % i,
+                    'fuel': self._random.randint(24, 40 * 24) * 40,
+                    'fuel_per_hour': 40,
+                    'location': {'orbit_id': ORBIT_BASE + i,
+                                 'orbit_name': 'System %d - Moon %d' % (i // 30, i % 30)},
+                })
+            self._corps.append(corp)
+        self._render()
+
+    def _render(self):
+        lines = []
+        for corp in self._corps:
+            lines.append(json.dumps(dict(corp, cache_ts=corp['cache_ts'].strftime(
+                '%Y-%m-%d %H:%M:%S'))))
+        self._body = '\n'.join(lines) + '\n'
+        self._etag = '"%d"' % self._generation
+
+    def advance(self, fraction):
+        now = datetime.utcnow().replace(microsecond=0)
+        for corp in self._corps:
+            for tower in corp['towers']:
+                if self._random.random() < fraction:
+                    tower['fuel'] = self._random.randint(24, 40 * 24) * 40
+                    corp['cache_ts'] = now
+        self._generation += 1
+        self._render()
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] == 'POST' and environ['PATH_INFO'] == '/advance':
+            query = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+            self.advance(float(query.get('fraction', ['0.1'])[0]))
+            return _respond(start_response, 204)
+        if environ.get('HTTP_IF_NONE_MATCH') == self._etag:
+            return _respond(start_response, 304)
+        return _respond(start_response, 200, self._body, 'text/plain',
+                        [('ETag', self._etag)])
+
+
+class FakeCalendar(object):
+    # Calendars spring into existence when first used. Deleted events are
+    # kept as cancelled, so incremental syncs can report them.
+    ROUTES = [
+        ('GET', re.compile(r'^/calendar/v3/calendars/([^/]+)$'), 'calendar.calendars.get'),
+        ('POST', re.compile(r'^/calendar/v3/calendars$'), 'calendar.calendars.insert'),
+        ('GET', re.compile(r'^/calendar/v3/calendars/([^/]+)/events$'), 'calendar.events.list'),
+        ('POST', re.compile(r'^/calendar/v3/calendars/([^/]+)/events$'),
+         'calendar.events.insert'),
+        ('PUT', re.compile(r'^/calendar/v3/calendars/([^/]+)/events/([^/]+)$'),
+         'calendar.events.update'),
+        ('DELETE', re.compile(r'^/calendar/v3/calendars/([^/]+)/events/([^/]+)$'),
+         'calendar.events.delete'),
+    ]
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._calendars = defaultdict(dict)
+        self._ids = itertools.count(1)
+        # Bumped on every event change; sync tokens are values of it
+        self._seq = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {'http_requests': 0, 'batches': 0, 'errors': 0,
+                      'calls': defaultdict(int)}
+
+    @staticmethod
+    def _method(method_id, path, http_method, params, request=None, response=None):
+        desc = {'id': method_id,
+                'path': path,
+                'httpMethod': http_method,
+                'parameters': {name: {'type': 'string', 'location': location,
+                                      'required': location == 'path'}
+                               for name, location in params},
+                'parameterOrder': [name for name, location in params if location == 'path']}
+        if request is not None:
+            desc['request'] = {'$ref': request}
+        if response is not None:
+            desc['response'] = {'$ref': response}
+        return desc
+
+    def discovery(self, root_url):
+        method = self._method
+        return {
+            'kind': 'discovery#restDescription',
+            'name': 'calendar',
+            'version': 'v3',
+            'rootUrl': root_url,
+            'servicePath': 'calendar/v3/',
+            'batchPath': 'batch/calendar/v3',
+            'parameters': {},
+            'schemas': {'Calendar': {'id': 'Calendar', 'type': 'object'},
+                        'Event': {'id': 'Event', 'type': 'object'},
+                        'Events': {'id': 'Events', 'type': 'object'}},
+            'resources': {
+                'calendars': {'methods': {
+                    'get': method('calendar.calendars.get', 'calendars/{calendarId}', 'GET',
+                                  [('calendarId', 'path')], response='Calendar'),
+                    'insert': method('calendar.calendars.insert', 'calendars', 'POST', [],
+                                     'Calendar', 'Calendar'),
+                }},
+                'events': {'methods': {
+                    'list': method('calendar.events.list', 'calendars/{calendarId}/events',
+                                   'GET', [('calendarId', 'path'), ('syncToken', 'query'),
+                                           ('pageToken', 'query')], response='Events'),
+                    'insert': method('calendar.events.insert', 'calendars/{calendarId}/events',
+                                     'POST', [('calendarId', 'path')], 'Event', 'Event'),
+                    'update': method('calendar.events.update',
+                                     'calendars/{calendarId}/events/{eventId}', 'PUT',
+                                     [('calendarId', 'path'), ('eventId', 'path')],
+                                     'Event', 'Event'),
+                    'delete': method('calendar.events.delete',
+                                     'calendars/{calendarId}/events/{eventId}', 'DELETE',
+                                     [('calendarId', 'path'), ('eventId', 'path')]),
+                }},
+            },
+        }
+
+    def _error(self, status, reason):
+        return status, {'error': {'code': status, 'message': reason,
+                                  'errors': [{'reason': reason}]}}
+
+    def _list_events(self, events, query):
+        sync_token = query.get('syncToken')
+        offset, seq = 0, self._seq
+        if 'pageToken' in query:
+            offset, seq = map(int, query['pageToken'].split(':'))
+        if sync_token is not None:
+            if int(sync_token) > self._seq:
+                return self._error(410, 'fullSyncRequired')
+            items = [e for e in events.itervalues() if int(sync_token) < e['_seq'] <= seq]
+        else:
+            items = [e for e in events.itervalues()
+                     if e['status'] != 'cancelled' and e['_seq'] <= seq]
+        response = {'kind': 'calendar#events',
+                    'items': [{k: v for k, v in e.iteritems() if k != '_seq'}
+                              for e in items[offset:offset + PAGE_SIZE]]}
+        if offset + PAGE_SIZE < len(items):
+            response['nextPageToken'] = '%d:%d' % (offset + PAGE_SIZE, seq)
+        else:
+            response['nextSyncToken'] = str(seq)
+        return 200, response
+
+    def _save_event(self, events, event_id, body):
+        self._seq += 1
+        event = dict(body, id=event_id, status='confirmed', _seq=self._seq)
+        event.setdefault('sequence', 0)
+        events[event_id] = event
+        return 200, {k: v for k, v in event.iteritems() if k != '_seq'}
+
+    def handle(self, http_method, path, query, body):
+        for route_method, pattern, method_id in self.ROUTES:
+            match = pattern.match(path)
+            if route_method == http_method and match:
+                break
+        else:
+            return self._error(404, 'notFound')
+        self.stats['calls'][method_id] += 1
+        if self._random.random() < self.error_rate:
+            self.stats['errors'] += 1
+            if self._random.random() < 0.5:
+                return self._error(403, 'userRateLimitExceeded')
+            return self._error(503, 'backendError')
+
+        args = [urlparse.unquote(arg) for arg in match.groups()]
+        if method_id == 'calendar.calendars.insert':
+            cal_id = 'cal-%d' % next(self._ids)
+            self._calendars[cal_id] = {}
+            return 200, dict(json.loads(body or '{}'), id=cal_id)
+        events = self._calendars[args[0]]
+        if method_id == 'calendar.calendars.get':
+            return 200, {'id': args[0], 'summary': 'EVE POS events'}
+        elif method_id == 'calendar.events.list':
+            return self._list_events(events, query)
+        elif method_id == 'calendar.events.insert':
+            return self._save_event(events, 'evt%d' % next(self._ids), json.loads(body))
+        event = events.get(args[1])
+        if event is None or event['status'] == 'cancelled':
+            return self._error(404, 'notFound')
+        if method_id == 'calendar.events.update':
+            return self._save_event(events, args[1], json.loads(body))
+        self._seq += 1
+        event.update(status='cancelled', _seq=self._seq)
+        return 204, None
+
+    def _handle_batch(self, environ):
+        # Requests arrive as application/http parts of a multipart/mixed body
+        parser = email.parser.FeedParser()
+        parser.feed('Content-Type: %s\r\n\r\n' % environ['CONTENT_TYPE'])
+        parser.feed(environ['wsgi.input'].read())
+        boundary = 'batch_fake_boundary'
+        out = []
+        for part in parser.close().get_payload():
+            # Parts without a body (such as deletes) end with their headers
+            sections = re.split(r'\r?\n\r?\n', part.get_payload(), 1)
+            head, body = sections[0], sections[1] if len(sections) > 1 else ''
+            http_method, uri = head.splitlines()[0].split(' ')[:2]
+            parsed = urlparse.urlparse(uri)
+            query = {k: v[0] for k, v in urlparse.parse_qs(parsed.query).iteritems()}
+            status, response = self.handle(http_method, parsed.path, query, body)
+            content = json.dumps(response) if response is not None else ''
+            out.append('--%s\r\nContent-Type: application/http\r\nContent-ID: <response-%s>\r\n'
+                       '\r\nHTTP/1.1 %d %s\r\nContent-Type: application/json\r\n\r\n%s\r\n' % (
+                           boundary, part['Content-ID'][1:-1], status, STATUS_TEXT[status],
+                           content))
+        out.append('--%s--\r\n' % boundary)
+        return 'multipart/mixed; boundary=%s' % boundary, ''.join(out)
+
+    def __call__(self, environ, start_response):
+        http_method = environ['REQUEST_METHOD']
+        path = environ['PATH_INFO']
+        if path == '/stats':
+            if http_method == 'POST':
+                self.reset_stats()
+            return _respond(start_response, 200, json.dumps(self.stats))
+        if path.startswith('/discovery/'):
+            root_url = 'http://%s/' % environ['HTTP_HOST']
+            return _respond(start_response, 200, json.dumps(self.discovery(root_url)))
+
+        self.stats['http_requests'] += 1
+        if self.latency:
+            gevent.sleep(self.latency)
+        if path == '/batch/calendar/v3':
+            self.stats['batches'] += 1
+            content_type, body = self._handle_batch(environ)
+            return _respond(start_response, 200, body, content_type)
+
+        query = {k: v[0] for k, v in urlparse.parse_qs(environ.get('QUERY_STRING', '')).iteritems()}
+        status, response = self.handle(http_method, path, query, environ['wsgi.input'].read())
+        return _respond(start_response, status,
+                        json.dumps(response) if response is not None else '')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--towers', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every Calendar HTTP request')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of Calendar calls failing with a retryable error')
+    args = parser.parse_args()
+
+    posmon = WSGIServer(('127.0.0.1', 0), PosmonFeed(args.towers), log=None)
+    calendar = WSGIServer(('127.0.0.1', 0), FakeCalendar(args.latency, args.error_rate),
+                          log=None)
+    posmon.start()
+    calendar.start()
+    print(json.dumps({'posmon': posmon.server_port, 'calendar': calendar.server_port}))
+    sys.stdout.flush()
+    gevent.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# Runs CalendarService.run_for_all against the fake posmon and Calendar
+# servers from bench/fakes.py, over a SQLite database holding a synthetic
+# population. Each population runs in its own process, through four update
+# cycles: the first creates every event, the second follows a feed update
+# that refuels a fraction of the towers, the third sees no changes, and the
+# fourth follows characters dropping a fraction of their towers.
+#
+#   python -m bench.sync_cycle [--chars 10,100,1000,10000] [--latency S]
+#                              [--error-rate P] [--churn F] [--reminders 7d,2d,6h]
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import argparse
+import json
+import logging
+import os
+import random
+import requests
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from oauth2client.client import OAuth2Credentials
+from sqlalchemy import event
+
+from eveposcal import default_config, metrics
+from eveposcal.app import app, db
+from eveposcal.calendar_service import CalendarService, parse_reminders
+from eveposcal.model import db as db_model
+from eveposcal.model.db import EnabledTowers, Settings, Token
+
+from .fakes import ORBIT_BASE
+
+TOWERS_PER_CHAR = 10
+ROW = '%-7s %6s %6s %8s %7s %7s %6s %7s %6s %8s %5s %5s %5s %8s'
+HEADER = ROW % ('cycle', 'chars', 'towers', 'wall_s', 'calls', 'deletes', 'http', 'batches',
+                'retry', 'queries', 'ok', 'skip', 'fail', 'rss_mb')
+
+
+def populate(chars, towers, reminders=None):
+    creds = OAuth2Credentials('bench-access-token', 'bench-client', 'bench-secret',
+                              'bench-refresh-token', datetime.utcnow() + timedelta(days=30),
+                              'http://127.0.0.1:1/token', 'eveposcal-bench').to_json()
+    rng = random.Random(0)
+    enabled = [{'char_id': c, 'orbit_id': ORBIT_BASE + o}
+               for c in xrange(chars)
+               for o in rng.sample(xrange(towers), min(TOWERS_PER_CHAR, towers))]
+    db.session.execute(EnabledTowers.__table__.insert(), enabled)
+    db.session.execute(Settings.__table__.insert(),
+                       [{'char_id': c, 'key': Settings.CALENDAR, 'value': 'cal%d' % (c,)}
+                        for c in xrange(chars)])
+    if reminders:
+        db.session.execute(Settings.__table__.insert(),
+                           [{'char_id': c, 'key': Settings.REMINDERS,
+                             'value': ','.join(str(r) for r in reminders)}
+                            for c in xrange(chars)])
+    db.session.execute(Token.__table__.insert(),
+                       [{'char_id': c, 'kind': Token.GOOGLE_OAUTH, 'value': creds}
+                        for c in xrange(chars)])
+    db.session.commit()
+    db.session.remove()
+
+
+def remove_towers(fraction):
+    # Each character drops about fraction of its towers
+    rng = random.Random(1)
+    removed = [(char_id, orbit_id) for char_id, orbit_id in
+               db.session.query(EnabledTowers.char_id, EnabledTowers.orbit_id)
+               if rng.random() < fraction]
+    for char_id, orbit_id in removed:
+        EnabledTowers.query.filter_by(char_id=char_id, orbit_id=orbit_id).delete()
+    db.session.commit()
+    db.session.remove()
+
+
+def run_cycle(service, label, chars, towers, calendar_url, queries):
+    requests.post(calendar_url + 'stats')
+    results = ('success', 'skipped', 'aborted', 'error')
+    runs_before = {result: metrics.RUNS.get(result=result) for result in results}
+    retries_before = metrics.API_RETRIES.get()
+    queries_before = queries[0]
+
+    start = time.time()
+    service.run_for_all()
+    wall = time.time() - start
+
+    stats = requests.get(calendar_url + 'stats').json()
+    runs = {result: metrics.RUNS.get(result=result) - runs_before[result] for result in results}
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    print(ROW % (label, chars, towers, '%.2f' % wall, sum(stats['calls'].values()),
+                 stats['calls'].get('calendar.events.delete', 0),
+                 stats['http_requests'], stats['batches'],
+                 int(metrics.API_RETRIES.get() - retries_before), queries[0] - queries_before,
+                 int(runs['success']), int(runs['skipped']),
+                 int(runs['aborted'] + runs['error']), '%.1f' % peak_rss))
+    sys.stdout.flush()
+
+
+def run_population(args, chars):
+    towers = args.towers or max(chars * 2, TOWERS_PER_CHAR)
+    fakes = subprocess.Popen([sys.executable, '-m', 'bench.fakes', '--towers', str(towers),
+                              '--latency', str(args.latency),
+                              '--error-rate', str(args.error_rate)],
+                             stdout=subprocess.PIPE)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        ports = json.loads(fakes.stdout.readline())
+        posmon_url = 'http://127.0.0.1:%d/' % (ports['posmon'],)
+        calendar_url = 'http://127.0.0.1:%d/' % (ports['calendar'],)
+        app.config.from_object(default_config)
+        app.config.update(
+            SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(tmp_dir, 'bench.db'),
+            POSMON_URL=posmon_url,
+            DISCOVERY_URI=calendar_url + 'discovery/v1/apis/{api}/{apiVersion}/rest',
+            CALENDAR_CONCURRENCY=args.concurrency,
+            CALENDAR_RATE_LIMIT=args.rate_limit,
+            CALENDAR_RATE_BURST=args.rate_limit,
+        )
+        db.create_all()
+        db_model.upgrade_schema()
+        populate(chars, towers, args.reminders and parse_reminders(args.reminders))
+
+        queries = [0]
+
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def _count_query(*args):
+            queries[0] += 1
+
+        service = CalendarService()
+        run_cycle(service, 'initial', chars, towers, calendar_url, queries)
+        requests.post(posmon_url + 'advance', params={'fraction': args.churn})
+        run_cycle(service, 'changed', chars, towers, calendar_url, queries)
+        run_cycle(service, 'steady', chars, towers, calendar_url, queries)
+        remove_towers(args.churn)
+        run_cycle(service, 'removed', chars, towers, calendar_url, queries)
+    finally:
+        db.session.remove()
+        fakes.kill()
+        fakes.wait()
+        shutil.rmtree(tmp_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chars', default='10,100,1000,10000',
+                        help='comma separated population sizes')
+    parser.add_argument('--towers', type=int, default=0,
+                        help='towers in the feed (default: twice the characters)')
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--churn', type=float, default=0.1,
+                        help='fraction of towers refueled before the second cycle, and '
+                        'dropped before the fourth')
+    parser.add_argument('--reminders', help='reminders for every character (default: '
+                        'DEFAULT_REMINDERS_S)')
+    parser.add_argument('--concurrency', type=int, default=default_config.CALENDAR_CONCURRENCY)
+    parser.add_argument('--rate-limit', type=float, default=1000000)
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--population', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+
+    if args.population is not None:
+        run_population(args, args.population)
+        return
+
+    # Peak RSS is per process, so each population gets a fresh one
+    print(HEADER)
+    sys.stdout.flush()
+    for chars in [int(n) for n in args.chars.split(',')]:
+        subprocess.check_call([sys.executable, '-m', 'bench.sync_cycle',
+                               '--population', str(chars)] + sys.argv[1:])
+
+
+if __name__ == '__main__':
+    main()
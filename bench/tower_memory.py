@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Compares the memory held by N parsed towers against keeping the raw JSON
+# dicts around, which is what Tower used to do.
+#
+#   python -m bench.tower_memory [count]
+import gc
+import sys
+from datetime import datetime
+
+from eveposcal.model.posmon import Tower, TowerSet
+
+
+def make_tower_json(i):
+    return {
+        'name': 'Tower %d' % (i,),
+        'fuel': 10000 + i,
+        'fuel_per_hour': 40,
+        'state': 'online',
+        'type_id': 12235,
+        'moon_id': 40000000 + i,
+        'location': {'orbit_id': 40000000 + i,
+                     'orbit_name': 'System %d - Moon %d' % (i // 30, i % 30),
+                     'solar_system_id': 30000000 + i // 30,
+                     'region_id': 10000000 + i // 3000},
+        'resources': [{'type_id': 4051, 'quantity': 10000 + i},
+                      {'type_id': 16275, 'quantity': 4000}],
+    }
+
+
+def deep_sizeof(obj, seen=None):
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(v, seen) for v in obj)
+    for attr in getattr(type(obj), '__slots__', ()):
+        if hasattr(obj, attr):
+            size += deep_sizeof(getattr(obj, attr), seen)
+    if hasattr(obj, '__dict__'):
+        size += deep_sizeof(obj.__dict__, seen)
+    return size
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    cache_ts = datetime(2014, 11, 20, 12, 0, 0)
+    raw = dict((j['location']['orbit_id'], j)
+               for j in (make_tower_json(i) for i in range(count)))
+    towers = TowerSet((orbit_id, Tower(j, cache_ts, 'Corp'))
+                      for orbit_id, j in raw.items())
+    gc.collect()
+
+    raw_size = deep_sizeof(raw)
+    tower_size = deep_sizeof(towers)
+    print('%d towers' % (count,))
+    print('raw JSON:  %10d bytes (%d per tower)' % (raw_size, raw_size // count))
+    print('TowerSet:  %10d bytes (%d per tower)' % (tower_size, tower_size // count))
+
+
+if __name__ == '__main__':
+    main()
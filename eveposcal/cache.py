@@ -0,0 +1,36 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    # A size-bounded LRU mapping whose entries can also expire. Expired
+    # entries are dropped when they are looked up or pushed out by new ones.
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires is not None and expires <= time.time():
+            return default
+        self._entries[key] = entry
+        return value
+
+    def set(self, key, value, expires=None):
+        if expires is None and self.ttl is not None:
+            expires = time.time() + self.ttl
+        self._entries.pop(key, None)
+        self._entries[key] = (expires, value)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
@@ -1,29 +1,139 @@
+import calendar
+import functools
 import gevent
+import hashlib
+import httplib2
+import itertools
+import json
 import logging
+import os
+import random
+import re
+import socket
 import time
-from collections import defaultdict
+import uuid
+import zlib
 from datetime import datetime, timedelta
-from gevent.lock import Semaphore
+from gevent.pool import Pool
 
-from googleapiclient import discovery
 from googleapiclient.errors import HttpError
+from sqlalchemy.exc import IntegrityError
 
+from . import google_api, metrics
 from .app import app, db
-from .model.db import CalendarEvent, EnabledTowers, Settings, Token
+from .cache import TTLCache
+from .model.db import (CalendarEvent, EnabledTowers, RunLease, ServiceLease, Settings, Token,
+                       TowerHorizon, WorkerMetrics)
 from .model.posmon import Tower
+from .ratelimit import TokenBucket
 
 logger = logging.getLogger(__name__)
 
 
+_REMINDER_RE = re.compile(r'^(?:(\d+)d)?(?:(\d+)h)?(?:(\d+)m)?$')
+
+
+def parse_reminders(text):
+    # "7d, 2d, 6h" -> [604800, 172800, 21600]
+    reminders = set()
+    for part in text.replace(' ', '').lower().split(','):
+        match = _REMINDER_RE.match(part)
+        if not part or not match:
+            raise ValueError('Invalid reminder %r' % (part,))
+        days, hours, minutes = (int(n or 0) for n in match.groups())
+        reminders.add(((days * 24 + hours) * 60 + minutes) * 60)
+    if (0 in reminders or len(reminders) > CalendarServiceRun.MAX_REMINDERS or
+            max(reminders) > CalendarServiceRun.MAX_REMINDER_S):
+        raise ValueError('Invalid reminders %r' % (text,))
+    return sorted(reminders, reverse=True)
+
+
+def format_reminders(reminders):
+    parts = []
+    for reminder_s in reminders:
+        days, rest = divmod(reminder_s, 24 * 60 * 60)
+        hours, rest = divmod(rest, 60 * 60)
+        part = ''.join('%d%s' % (n, unit) for n, unit in
+                       ((days, 'd'), (hours, 'h'), (rest // 60, 'm')) if n)
+        parts.append(part)
+    return ', '.join(parts)
+
+
 class RunAbortedException(Exception):
     def __init__(self, code):
         self.code = code
 
 
 class CalendarServiceRun(object):
-    def __init__(self, char_id):
+    # Maximum number of calls the Calendar API accepts in one batch request
+    BATCH_SIZE = 50
+    # Events are only moved if their start time changes by more than this
+    UPDATE_THRESHOLD = timedelta(hours=1)
+    # 403 reasons that mean "slow down" rather than "forbidden"
+    RATE_LIMIT_REASONS = frozenset(['rateLimitExceeded', 'userRateLimitExceeded'])
+    MAX_BACKOFF_S = 32
+    # Characters per bulk query in load()
+    LOAD_CHUNK = 500
+    # Reminders per tower, and how far ahead of running out of fuel they
+    # can be
+    MAX_REMINDERS = 5
+    MAX_REMINDER_S = 30 * 24 * 60 * 60
+
+    def __init__(self, char_id, towers=None, limiter=None):
         self.cal_api = None
         self.char_id = char_id
+        self.towers = towers
+        self.limiter = limiter
+        self.max_retries = app.config['CALENDAR_MAX_RETRIES']
+        self.skipped = False
+
+        # Database state, filled in by load()
+        self.token = None
+        self.cal_id = None
+        self.sync_token = None
+        self.enabled = set()
+        self.reminders = app.config['DEFAULT_REMINDERS_S']
+        self.stored_events = []
+
+        # CalendarEvent changes, written in bulk when the run commits
+        self._event_rows = {}
+        self._forgotten = set()
+
+    @classmethod
+    def load(cls, char_ids, towers=None, limiter=None):
+        # Builds runs for char_ids, reading everything they need from the
+        # database in a few bulk queries. The rows are detached from the
+        # session, as each run uses its own.
+        runs = {}
+        char_ids = list(char_ids)
+        with metrics.RUN_PHASE_SECONDS.time(phase='db_load'):
+            cls._load_chunks(runs, char_ids, towers, limiter)
+        return runs
+
+    @classmethod
+    def _load_chunks(cls, runs, char_ids, towers, limiter):
+        for i in xrange(0, len(char_ids), cls.LOAD_CHUNK):
+            chunk = char_ids[i:i + cls.LOAD_CHUNK]
+            for char_id in chunk:
+                runs[char_id] = cls(char_id, towers, limiter)
+            for char_id, token in Token.multiget_google_oauth(chunk).iteritems():
+                runs[char_id].token = token
+            for char_id, cal_id in Settings.multiget(chunk, Settings.CALENDAR).iteritems():
+                runs[char_id].cal_id = cal_id
+            for char_id, sync_token in Settings.multiget(chunk, Settings.SYNC_TOKEN).iteritems():
+                runs[char_id].sync_token = sync_token
+            for char_id, reminders in Settings.multiget(chunk, Settings.REMINDERS).iteritems():
+                # Settings saved before MAX_REMINDER_S was enforced may be
+                # out of range
+                reminders = [int(r) for r in reminders.split(',')
+                             if 0 < int(r) <= cls.MAX_REMINDER_S]
+                if reminders:
+                    runs[char_id].reminders = reminders
+            for e in EnabledTowers.get_for_chars(chunk):
+                runs[e.char_id].enabled.add(e.orbit_id)
+            for evt in CalendarEvent.get_for_chars(chunk):
+                runs[evt.char_id].stored_events.append(evt)
+            db.session.expunge_all()
 
     @staticmethod
     def _format_date(dt):
@@ -33,204 +143,809 @@ class CalendarServiceRun(object):
     def _parse_date(dt):
         return datetime.strptime(dt['dateTime'], '%Y-%m-%dT%H:%M:%SZ')
 
+    @staticmethod
+    def _key(evt):
+        return (evt.orbit_id, evt.reminder_s)
+
     def _get_calendar(self):
-        cal_id = Settings.get(self.char_id, Settings.CALENDAR)
+        cal_id = self.cal_id
         try:
-            self.cal_api.calendars().get(calendarId=cal_id).execute()
+            self._execute(self.cal_api.calendars().get(calendarId=cal_id))
         except HttpError as e:
             logger.debug("Failed to fetch calendar for char_id=%s", self.char_id, exc_info=True)
-            if e.resp.status == 401:
-                raise RunAbortedException('auth')
-            elif e.resp.status == 404:
+            if e.resp.status == 404:
                 raise RunAbortedException('calendar_missing')
-            else:
-                raise RunAbortedException('api_failure')
+            self._raise_for_error(e)
         return cal_id
 
-    def _get_events(self, cal_id):
-        existing = {}
-        for evt in CalendarEvent.get_for_char(self.char_id):
+    @classmethod
+    def _is_rate_limited(cls, e):
+        if e.resp.status == 429:
+            return True
+        elif e.resp.status != 403:
+            return False
+        try:
+            errors = json.loads(e.content)['error']['errors']
+            return any(err.get('reason') in cls.RATE_LIMIT_REASONS for err in errors)
+        except (ValueError, KeyError, TypeError):
+            return False
+
+    def _should_retry(self, e, attempt):
+        if attempt >= self.max_retries or not isinstance(e, HttpError):
+            return False
+        return e.resp.status >= 500 or self._is_rate_limited(e)
+
+    def _backoff(self, attempt):
+        metrics.API_RETRIES.inc()
+        delay = min(2 ** attempt + random.random(), self.MAX_BACKOFF_S)
+        logger.debug('Backing off %.1fs for char_id=%d', delay, self.char_id)
+        gevent.sleep(delay)
+
+    def _raise_for_error(self, e):
+        if e.resp.status == 401:
+            raise RunAbortedException('auth')
+        elif self._is_rate_limited(e):
+            raise RunAbortedException('rate_limited')
+        else:
+            raise RunAbortedException('api_failure')
+
+    def _execute(self, request):
+        for attempt in itertools.count():
+            if self.limiter is not None:
+                self.limiter.acquire()
+            metrics.API_CALLS.inc(method=request.methodId)
+            metrics.API_REQUESTS.inc(kind='single')
+            try:
+                return request.execute()
+            except HttpError as e:
+                if not self._should_retry(e, attempt):
+                    raise
+            self._backoff(attempt)
+
+    def _execute_batch(self, requests):
+        # Returns {key: (response, exception)} for a list of (key, request)
+        # pairs, sent BATCH_SIZE at a time. Items that fail with a retryable
+        # error are resent in a later batch. If a whole batch fails for good,
+        # it and everything after it get that error, and earlier results are
+        # still returned.
+        results = {}
+        keys = [key for key, _ in requests]
+
+        def callback(request_id, response, exception):
+            results[keys[int(request_id)]] = (response, exception)
+
+        requests = list(enumerate(request for _, request in requests))
+        for i in xrange(0, len(requests), self.BATCH_SIZE):
+            pending = requests[i:i + self.BATCH_SIZE]
+            for attempt in itertools.count():
+                batch = google_api.new_batch('calendar', 'v3', callback)
+                for n, request in pending:
+                    batch.add(request, request_id=str(n))
+                if self.limiter is not None:
+                    self.limiter.acquire(len(pending))
+                for _, request in pending:
+                    metrics.API_CALLS.inc(method=request.methodId)
+                metrics.API_REQUESTS.inc(kind='batch')
+                try:
+                    batch.execute()
+                except HttpError as e:
+                    logger.debug('Batch request failed for char_id=%d', self.char_id,
+                                 exc_info=True)
+                    if not self._should_retry(e, attempt):
+                        for n, _ in pending + requests[i + self.BATCH_SIZE:]:
+                            results[keys[n]] = (None, e)
+                        return results
+                else:
+                    pending = [(n, request) for n, request in pending
+                               if self._should_retry(results[keys[n]][1], attempt)]
+                    if not pending:
+                        break
+                self._backoff(attempt)
+        return results
+
+    def _list_events(self, cal_id, sync_token):
+        kwargs = {'calendarId': cal_id}
+        if sync_token:
+            kwargs['syncToken'] = sync_token
+        items = []
+        while True:
+            response = self._execute(self.cal_api.events().list(**kwargs))
+            items.extend(response.get('items', []))
+            if 'nextPageToken' not in response:
+                return items, response.get('nextSyncToken')
+            kwargs['pageToken'] = response['nextPageToken']
+
+    def _get_events(self, cal_id, stored_events):
+        stored = {evt.event_id: evt for evt in stored_events}
+        sync_token = self.sync_token
+        if any(evt.start is None for evt in stored.itervalues()):
+            sync_token = None
+
+        # List changes since the last run, or everything if we have no
+        # (valid) sync token
+        try:
             try:
-                cal_event = self.cal_api.events().get(calendarId=cal_id,
-                                                      eventId=evt.event_id).execute()
-                if cal_event['status'] != 'cancelled':
-                    existing[evt.orbit_id] = cal_event
+                items, next_sync_token = self._list_events(cal_id, sync_token)
             except HttpError as e:
-                logger.debug('Failed to fetch calendar event for char_id=%d orbit_id=%d',
-                             self.char_id, evt.orbit_id)
-                if e.resp.status == 401:
-                    raise RunAbortedException('auth')
-                elif e.resp.status != 404:
-                    raise RunAbortedException('api_failure')
+                if not sync_token or e.resp.status != 410:
+                    raise
+                logger.info('Sync token expired for char_id=%d, doing full sync', self.char_id)
+                sync_token = None
+                items, next_sync_token = self._list_events(cal_id, None)
+        except HttpError as e:
+            logger.debug('Failed to list calendar events for char_id=%d', self.char_id,
+                         exc_info=True)
+            self._raise_for_error(e)
+        Settings.set(self.char_id, Settings.SYNC_TOKEN, next_sync_token)
+
+        # On an incremental sync, unchanged events are taken from the database
+        existing = {}
+        if sync_token:
+            for evt in stored.itervalues():
+                existing[self._key(evt)] = {'id': evt.event_id,
+                                            'start': self._format_date(evt.start),
+                                            'sequence': evt.sequence}
+        for cal_event in items:
+            evt = stored.get(cal_event['id'])
+            if evt is None:
+                continue
+            if cal_event['status'] == 'cancelled':
+                existing.pop(self._key(evt), None)
+            else:
+                existing[self._key(evt)] = cal_event
+                self._remember(self._key(evt), cal_event, evt.fingerprint)
+
+        # Forget events that no longer exist in Google
+        for evt in stored.itervalues():
+            if self._key(evt) not in existing:
+                self._forget(self._key(evt))
         return existing
 
     def _make_event_args(self, towers):
+        # Event arguments keyed by (orbit_id, reminder_s). Start times are
+        # worked out on epoch seconds (rounded down to the hour) for every
+        # tower and reminder in one pass, and each distinct hour is only
+        # formatted once.
+        expirations = [(orbit_id, tower, calendar.timegm(tower.get_fuel_expiration().timetuple()))
+                       for orbit_id, tower in towers.iteritems()]
+        starts = [(orbit_id, tower, reminder_s, (expires - reminder_s) // 3600 * 3600)
+                  for orbit_id, tower, expires in expirations
+                  for reminder_s in self.reminders]
+        dates = {}
         args = {}
-        # FIXME: Make this configurable
-        offset = timedelta(days=2, hours=1)
-        for orbit_id, tower in towers.iteritems():
-            expires = (tower.get_fuel_expiration() - offset).replace(minute=0, second=0)
-            args[orbit_id] = {
+        for orbit_id, tower, reminder_s, start in starts:
+            date = dates.get(start)
+            if date is None:
+                date = dates[start] = self._format_date(datetime.utcfromtimestamp(start))
+            args[(orbit_id, reminder_s)] = {
                 'summary': 'Refuel %s' % (tower.name,),
-                'start': self._format_date(expires),
-                'end': self._format_date(expires),
+                'start': date,
+                'end': date,
                 'location': tower.orbit_name,
             }
         return args
 
-    def _do_add(self, cal_id, orbit_id, event_args):
-        logger.info("Creating event for char_id=%s orbit_id=%s args=%s",
-                    self.char_id, orbit_id, event_args)
-        try:
-            response = self.cal_api.events().insert(calendarId=cal_id,
-                                                    body=event_args).execute()
-        except HttpError as e:
-            if e.resp.status == 401:
-                raise RunAbortedException('auth')
-            else:
-                raise RunAbortedException('api_failure')
-        event = CalendarEvent(char_id=self.char_id,
-                              orbit_id=orbit_id,
-                              event_id=response['id'])
-        db.session.merge(event)
-
-    def _do_update(self, cal_id, orbit_id, old_event, event_args):
+    @staticmethod
+    def _fingerprint(event_args):
+        # Covers everything but the times, which are compared against
+        # UPDATE_THRESHOLD instead
+        fields = {k: v for k, v in event_args.iteritems() if k not in ('start', 'end')}
+        return hashlib.sha1(json.dumps(fields, sort_keys=True)).hexdigest()
+
+    def _is_unchanged(self, stored_events, event_args):
+        if set(self._key(evt) for evt in stored_events) != set(event_args.iterkeys()):
+            return False
+        for evt in stored_events:
+            args = event_args[self._key(evt)]
+            if evt.start is None or evt.fingerprint != self._fingerprint(args):
+                return False
+            if abs(evt.start - self._parse_date(args['start'])) > self.UPDATE_THRESHOLD:
+                return False
+        return True
+
+    def _remember(self, key, cal_event, fingerprint):
+        self._forgotten.discard(key)
+        self._event_rows[key] = {'char_id': self.char_id,
+                                 'orbit_id': key[0],
+                                 'reminder_s': key[1],
+                                 'event_id': cal_event['id'],
+                                 'start': self._parse_date(cal_event['start']),
+                                 'sequence': cal_event['sequence'],
+                                 'fingerprint': fingerprint}
+
+    def _forget(self, key):
+        self._event_rows.pop(key, None)
+        self._forgotten.add(key)
+
+    def _record_event(self, key, response, event_args):
+        self._remember(key, response, self._fingerprint(event_args))
+
+    def _do_add(self, cal_id, key, event_args):
+        logger.info("Creating event for char_id=%s orbit_id=%s reminder_s=%s args=%s",
+                    self.char_id, key[0], key[1], event_args)
+        request = self.cal_api.events().insert(calendarId=cal_id, body=event_args)
+        return request, lambda response: self._record_event(key, response, event_args)
+
+    def _do_update(self, cal_id, key, old_event, old_fingerprint, event_args):
         start = self._parse_date(event_args['start'])
         existing_start = self._parse_date(old_event['start'])
-        if abs(existing_start - start) <= timedelta(hours=1):
-            return
-        logger.info("Updating event for char_id=%s orbit_id=%s args=%s",
-                    self.char_id, orbit_id, event_args)
-        try:
-            body = {'sequence': old_event['sequence'] + 1}
-            body.update(event_args)
-            self.cal_api.events().update(calendarId=cal_id,
-                                         eventId=old_event['id'],
-                                         body=body).execute()
-        except HttpError as e:
-            if e.resp.status == 401:
-                raise RunAbortedException('auth')
-            else:
+        if (abs(existing_start - start) <= self.UPDATE_THRESHOLD and
+                old_fingerprint == self._fingerprint(event_args)):
+            metrics.EVENTS_UNCHANGED.inc()
+            return None
+        logger.info("Updating event for char_id=%s orbit_id=%s reminder_s=%s args=%s",
+                    self.char_id, key[0], key[1], event_args)
+        body = {'sequence': old_event['sequence'] + 1}
+        body.update(event_args)
+        request = self.cal_api.events().update(calendarId=cal_id,
+                                               eventId=old_event['id'],
+                                               body=body)
+        return request, lambda response: self._record_event(key, response, event_args)
+
+    def _do_delete(self, cal_id, key, old_event):
+        logger.info("Deleting event for char_id=%s orbit_id=%s reminder_s=%s",
+                    self.char_id, key[0], key[1])
+        request = self.cal_api.events().delete(calendarId=cal_id, eventId=old_event['id'])
+
+        return request, lambda response: self._forget(key)
+
+    def _apply_changes(self, changes):
+        # Bookkeeping for every successful change is done before the first
+        # failure (if any) aborts the run, so the commit still records it.
+        results = self._execute_batch([(key, request)
+                                       for key, (request, _) in changes.iteritems()])
+        error = None
+        for key, (response, e) in results.iteritems():
+            if e is None:
+                done = changes[key][1]
+                if done is not None:
+                    done(response)
+            elif error is None:
+                logger.debug('Failed to change calendar event for char_id=%d key=%s',
+                             self.char_id, key)
+                error = e
+        if error is not None:
+            if not isinstance(error, HttpError):
                 raise RunAbortedException('api_failure')
-
-    def _do_delete(self, cal_id, orbit_id, old_event):
-        logger.info("Deleting event for char_id=%s orbit_id=%s",
-                    self.char_id, orbit_id)
-        try:
-            self.cal_api.events().delete(calendarId=cal_id, eventId=old_event['id']).execute()
-        except HttpError as e:
-            if e.resp.status == 401:
-                raise RunAbortedException('auth')
-            else:
-                raise RunAbortedException('api_failure')
-        CalendarEvent.delete(self.char_id, orbit_id)
+            self._raise_for_error(error)
 
     def _run(self):
         # Set up GCal API
-        token = Token.get_google_oauth(self.char_id)
-        if token is None:
+        if self.token is None:
             raise Exception("No Google Calendar API token")
-        self.cal_api = discovery.build('calendar', 'v3', credentials=token)
 
         # Fetch enabled towers from posmon
-        # FIXME: Do this up front / batched
-        enabled = set(e.orbit_id for e in EnabledTowers.get_for_char(self.char_id))
-        towers = Tower.fetch_all()
-        for orbit_id in towers.keys():
-            if orbit_id not in enabled:
-                del towers[orbit_id]
-
-        # Fetch existing calendar/events
-        cal_id = self._get_calendar()
-        existing = self._get_events(cal_id)
-
-        # Compute sets to add/update/delete
-        to_add = set(towers.iterkeys()) - set(existing.iterkeys())
-        to_update = set(towers.iterkeys()) & set(existing.iterkeys())
-        to_delete = set(existing.iterkeys()) - set(towers.iterkeys())
+        all_towers = self.towers
+        if all_towers is None:
+            with metrics.RUN_PHASE_SECONDS.time(phase='posmon'):
+                all_towers = Tower.fetch_shared()
+        towers = all_towers.subset(self.enabled)
 
         # Make event arguments for all towers
-        event_args = self._make_event_args(towers)
+        with metrics.RUN_PHASE_SECONDS.time(phase='event_args'):
+            event_args = self._make_event_args(towers)
+
+        # Skip talking to Google if nothing moved since the last push. A
+        # calendar without a sync token (new, or reset) is always read.
+        stored_events = self.stored_events
+        if self.sync_token and self._is_unchanged(stored_events, event_args):
+            self.skipped = True
+            return
+        fingerprints = {self._key(evt): evt.fingerprint for evt in stored_events}
 
-        # Perform calendar changes
-        for orbit_id in to_add:
-            self._do_add(cal_id, orbit_id, event_args[orbit_id])
-        for orbit_id in to_update:
-            self._do_update(cal_id, orbit_id, existing[orbit_id], event_args[orbit_id])
-        for orbit_id in to_delete:
-            self._do_delete(cal_id, orbit_id, existing[orbit_id])
+        # Fetch existing calendar/events
+        with google_api.service(self.char_id, self.token, 'calendar', 'v3') as self.cal_api:
+            with metrics.RUN_PHASE_SECONDS.time(phase='calendar'):
+                cal_id = self._get_calendar()
+            with metrics.RUN_PHASE_SECONDS.time(phase='events'):
+                existing = self._get_events(cal_id, stored_events)
+
+            # Compute sets to add/update/delete, by (orbit_id, reminder_s)
+            wanted = set(event_args.iterkeys())
+            to_add = wanted - set(existing.iterkeys())
+            to_update = wanted & set(existing.iterkeys())
+            to_delete = set(existing.iterkeys()) - wanted
+
+            # Perform calendar changes (the three sets are disjoint, so keys are
+            # unique within the batch)
+            changes = {}
+            for key in to_add:
+                changes[key] = self._do_add(cal_id, key, event_args[key])
+            for key in to_update:
+                change = self._do_update(cal_id, key, existing[key],
+                                         fingerprints.get(key), event_args[key])
+                if change is not None:
+                    changes[key] = change
+            for key in to_delete:
+                changes[key] = self._do_delete(cal_id, key, existing[key])
+            with metrics.RUN_PHASE_SECONDS.time(phase='changes'):
+                self._apply_changes(changes)
 
     def run(self):
         commit = True
         try:
-            self._run()
-            logger.info('Run for char_id=%d successful', self.char_id)
+            with metrics.RUN_PHASE_SECONDS.time(phase='total'):
+                self._run()
+            if self.skipped:
+                logger.info('Run for char_id=%d skipped, nothing changed', self.char_id)
+                metrics.RUNS.inc(result='skipped')
+            else:
+                logger.info('Run for char_id=%d successful', self.char_id)
+                metrics.RUNS.inc(result='success')
         except RunAbortedException as e:
             logger.warn('Run for char_id=%d aborted with %s', self.char_id, e.code)
+            metrics.RUNS.inc(result='aborted')
+            metrics.RUN_ABORTS.inc(code=e.code)
             raise
         except Exception:
+            metrics.RUNS.inc(result='error')
             commit = False
             raise
         finally:
             if commit:
-                db.session.commit()
+                with metrics.RUN_PHASE_SECONDS.time(phase='commit'):
+                    CalendarEvent.bulk_delete(self.char_id, self._forgotten)
+                    CalendarEvent.bulk_upsert(self.char_id, self._event_rows.values())
+                    db.session.commit()
+            db.session.remove()
+        return self
+
+
+class Job(object):
+    # Progress of runs requested through CalendarService.submit_*
+    def __init__(self, char_id=None):
+        self.id = uuid.uuid4().hex
+        self.char_id = char_id
+        self.status = 'queued'
+        self.total = None if char_id is None else 1
+        self.done = 0
+        self.skipped = 0
+        self.failed = {}
+
+    def started(self, total=None):
+        self.status = 'running'
+        if total is not None:
+            self.total = total
+        if self.total == 0:
+            self.status = 'done'
+
+    def finished(self, char_id, greenlet):
+        self.done += 1
+        if greenlet.successful():
+            self.skipped += greenlet.value.skipped
+        else:
+            self.failed[char_id] = getattr(greenlet.exception, 'code', 'error')
+        if self.done == self.total:
+            self.status = 'done'
+
+    def to_dict(self):
+        return {'id': self.id,
+                'char_id': self.char_id,
+                'status': self.status,
+                'total': self.total,
+                'done': self.done,
+                'skipped': self.skipped,
+                'failed': self.failed}
+
+
+class _CharRuns(object):
+    # The run executing for a character, the (single) run queued behind it,
+    # the jobs waiting on the queued run, and the (owner, claimed_at) of the
+    # character's RunLease once this worker holds it. The lease is held
+    # until neither run is left.
+    __slots__ = ('running', 'queued', 'jobs', 'lease')
+
+    def __init__(self):
+        self.running = None
+        self.queued = None
+        self.jobs = []
+        self.lease = None
 
 
 class CalendarService(object):
-    PERIOD_S = 60 * 60
+    # Characters are run as soon as the feed shows a change to one of their
+    # towers, so periodic runs are only a fallback
+    PERIOD_S = 6 * 60 * 60
+    # How long finished jobs can be looked up
+    JOB_TTL_S = 60 * 60
+    # How often the set of characters to schedule is reloaded
+    REFRESH_S = 5 * 60
+    # How long a claimed character is reserved for this worker, and the
+    # longest the scheduler sleeps before looking for due characters
+    LEASE_S = 15 * 60
+    POLL_S = 30
+    # How soon a run waiting on another worker's lease first checks again
+    CLAIM_RETRY_S = 1
+    # Access tokens expiring within TOKEN_REFRESH_AHEAD_S are refreshed in
+    # the background every TOKEN_REFRESH_S, so runs rarely refresh inline.
+    # Only the worker holding the token refresh lease does this; another
+    # takes over within TOKEN_LEASE_S if it stops.
+    TOKEN_REFRESH_S = 5 * 60
+    TOKEN_LEASE_S = 2 * TOKEN_REFRESH_S
+    TOKEN_REFRESH_AHEAD_S = 15 * 60
+    TOKEN_REFRESH_CONCURRENCY = 5
+    # How often this worker publishes its metrics for the others to report,
+    # and how long a stopped worker's last metrics are still reported
+    METRICS_FLUSH_S = 15
+    METRICS_MAX_AGE_S = 5 * 60
 
     def __init__(self):
         self._greenlet = None
-        self._locks = defaultdict(Semaphore)
+        self._token_greenlet = None
+        self._metrics_greenlet = None
+        # Only characters with a running or queued run have an entry
+        self._runs = {}
+        self._jobs = TTLCache(10000, ttl=self.JOB_TTL_S)
+        # Unfinished jobs by char_id (None for a job covering everyone)
+        self._pending_jobs = {}
+        self._pool = Pool(app.config['CALENDAR_CONCURRENCY'])
+        self.limiter = TokenBucket(app.config['CALENDAR_RATE_LIMIT'],
+                                   app.config['CALENDAR_RATE_BURST'])
+
+        self._worker_id = '%s:%d' % (socket.gethostname(), os.getpid())
+        # The last posmon snapshot checked for changes
+        self._watched_towers = None
+
+    def _next_slot(self, char_id, now):
+        # Each character gets a stable offset within the period, so runs are
+        # spread evenly instead of all firing at once
+        slot = zlib.crc32(str(char_id)) % self.PERIOD_S
+        due = now - now % self.PERIOD_S + slot
+        return due if due > now else due + self.PERIOD_S
+
+    def _refresh_schedule(self):
+        now = time.time()
+        with app.app_context():
+            RunLease.sync_members(
+                EnabledTowers.get_char_ids(),
+                lambda char_id: datetime.utcfromtimestamp(self._next_slot(char_id, now)))
+
+    @staticmethod
+    def _next_refresh(cache_ts, cadence, now):
+        # The first refresh after now, if posmon keeps its cadence
+        cadence = timedelta(seconds=cadence)
+        missed = (now - cache_ts).total_seconds() // cadence.total_seconds()
+        return (cache_ts + cadence * int(max(missed, 0) + 1) +
+                timedelta(seconds=app.config['POSMON_CHECK_GRACE_S']))
+
+    def _update_horizons(self, towers, now):
+        # Event times only move when posmon publishes new data for a tower,
+        # so nothing needs to be looked at before then
+        horizons = TowerHorizon.get_all()
+        rows = []
+        seen = set()
+        for orbit_id in EnabledTowers.get_orbit_ids():
+            tower = towers.get(orbit_id)
+            if tower is None:
+                continue
+            seen.add(orbit_id)
+            horizon = horizons.get(orbit_id)
+            cadence = horizon and horizon.cadence
+            if horizon is not None and tower.cache_ts > horizon.cache_ts:
+                cadence = int((tower.cache_ts - horizon.cache_ts).total_seconds())
+            next_check = self._next_refresh(tower.cache_ts,
+                                            cadence or app.config['POSMON_CADENCE_S'], now)
+            if (horizon is None or horizon.cache_ts != tower.cache_ts or
+                    horizon.cadence != cadence or horizon.next_check != next_check):
+                rows.append({'orbit_id': orbit_id, 'cache_ts': tower.cache_ts,
+                             'cadence': cadence, 'next_check': next_check})
+        try:
+            TowerHorizon.bulk_delete(set(horizons) - seen)
+            TowerHorizon.bulk_upsert(rows)
+            db.session.commit()
+        except IntegrityError:
+            # Another worker updated them first
+            db.session.rollback()
+
+    def _watch_feed(self):
+        # Expedites the characters subscribed to towers that changed since
+        # the last snapshot seen here, and returns when the feed is next
+        # expected to change
+        towers = Tower.fetch_shared(app.config['POSMON_CHECK_MIN_S'])
+        previous, self._watched_towers = self._watched_towers, towers
+        now = datetime.utcnow()
+        with app.app_context():
+            self._update_horizons(towers, now)
+            changed = towers.diff(previous) if previous is not None else ()
+            if changed:
+                subscribers = EnabledTowers.get_subscribers(changed)
+                char_ids = set(itertools.chain.from_iterable(subscribers.itervalues()))
+                RunLease.expedite(char_ids, now)
+                logger.info('%d towers changed in posmon feed, expedited %d characters',
+                            len(changed), len(char_ids))
+            return TowerHorizon.earliest()
+
+    def _release(self, char_id, owner, claimed_at):
+        due = self._next_slot(char_id, time.time())
+        try:
+            RunLease.release(char_id, owner, claimed_at, datetime.utcfromtimestamp(due))
+        finally:
+            db.session.remove()
+
+    def _wait_for_lease(self, char_id, runs):
+        # Runs only start while this worker holds the character's lease, so
+        # they never overlap another worker's. Returns whether it had to
+        # wait for the lease.
+        delay = self.CLAIM_RETRY_S
+        waited = False
+        while runs.lease is None:
+            owner = self._new_owner()
+            now = datetime.utcnow()
+            with app.app_context():
+                if RunLease.claim_char(char_id, owner, now,
+                                       now + timedelta(seconds=self.LEASE_S)):
+                    runs.lease = (owner, now)
+                    break
+            # The scheduler here may claim it first, and hand it over
+            waited = True
+            gevent.sleep(delay)
+            delay = min(delay * 2, self.POLL_S)
+        return waited
+
+    def _dispatch(self, char_ids, owner, claimed_at):
+        with metrics.RUN_PHASE_SECONDS.time(phase='posmon'):
+            towers = Tower.fetch_shared(app.config['POSMON_MAX_AGE_S'])
+        with app.app_context():
+            runs = CalendarServiceRun.load(char_ids, towers, self.limiter)
+        for char_id in char_ids:
+            self._spawn_run(char_id, towers, self._pool.start, runs[char_id],
+                            lease=(owner, claimed_at))
+
+    def _new_owner(self):
+        return '%s:%s' % (self._worker_id[:31], uuid.uuid4().hex)
+
+    def _claim(self):
+        # Only claim as many characters as can start right away, so other
+        # workers can pick up the rest
+        self._pool.wait_available()
+        owner = self._new_owner()
+        now = datetime.utcnow()
+        lease_until = now + timedelta(seconds=self.LEASE_S)
+        with app.app_context():
+            char_ids = RunLease.claim(owner, now, lease_until, max(self._pool.free_count(), 1))
+        return char_ids, owner, now
 
     def _greenlet_main(self):
-        next_t = time.time() + self.PERIOD_S
+        next_refresh = 0
+        next_watch = 0
         while True:
-            if time.time() < next_t:
-                gevent.sleep(next_t - time.time())
-                continue
-            else:
-                next_t = time.time() + self.PERIOD_S
+            now = time.time()
+            if now >= next_refresh:
+                try:
+                    self._refresh_schedule()
+                except Exception:
+                    logger.exception('Failed to refresh run schedule')
+                next_refresh = now + self.REFRESH_S
+            if now >= next_watch:
+                next_check = None
+                try:
+                    next_check = self._watch_feed()
+                except Exception:
+                    logger.exception('Failed to check posmon feed for changes')
+                next_watch = now + app.config['POSMON_CHECK_MAX_S']
+                if next_check is not None:
+                    next_watch = min(next_watch, calendar.timegm(next_check.timetuple()))
+                next_watch = max(next_watch, now + app.config['POSMON_CHECK_MIN_S'])
+
+            # Dispatch everything this worker could claim together, so its
+            # database reads are batched
+            try:
+                char_ids, owner, claimed_at = self._claim()
+                if char_ids:
+                    self._dispatch(char_ids, owner, claimed_at)
+                    continue
+                with app.app_context():
+                    next_due = RunLease.next_due(datetime.utcnow())
+            except Exception:
+                logger.exception('Failed to dispatch runs')
+                next_due = None
+
+            timeout = min(next_refresh - time.time(), next_watch - time.time(), self.POLL_S)
+            if next_due is not None:
+                timeout = min(timeout, (next_due - datetime.utcnow()).total_seconds())
+            gevent.sleep(max(timeout, 0))
+
+    def _refresh_token(self, char_id, creds):
+        try:
+            creds.refresh(httplib2.Http(timeout=app.config['GOOGLE_HTTP_TIMEOUT_S']))
+            db.session.commit()
+            logger.debug('Refreshed token for char_id=%s', char_id)
+        except Exception:
+            logger.warn('Failed to refresh token for char_id=%s', char_id, exc_info=True)
+        finally:
+            db.session.remove()
 
-            self.run_for_all()
+    def refresh_tokens(self):
+        pool = Pool(self.TOKEN_REFRESH_CONCURRENCY)
+        horizon = datetime.utcnow() + timedelta(seconds=self.TOKEN_REFRESH_AHEAD_S)
+        with app.app_context():
+            char_ids = EnabledTowers.get_char_ids()
+            for i in xrange(0, len(char_ids), CalendarServiceRun.LOAD_CHUNK):
+                tokens = Token.multiget_google_oauth(char_ids[i:i + CalendarServiceRun.LOAD_CHUNK])
+                db.session.expunge_all()
+                for char_id, creds in tokens.iteritems():
+                    if (creds.refresh_token and creds.token_expiry is not None and
+                            creds.token_expiry < horizon):
+                        pool.spawn(self._refresh_token, char_id, creds)
+        pool.join()
+
+    def _hold_lease(self, name, lease_s):
+        now = datetime.utcnow()
+        with app.app_context():
+            return ServiceLease.acquire(name, self._worker_id[:64], now,
+                                        now + timedelta(seconds=lease_s))
+
+    def _token_greenlet_main(self):
+        while True:
+            try:
+                if self._hold_lease(ServiceLease.TOKEN_REFRESH, self.TOKEN_LEASE_S):
+                    self.refresh_tokens()
+            except Exception:
+                logger.exception('Failed to refresh tokens')
+            gevent.sleep(self.TOKEN_REFRESH_S)
+
+    def _flush_metrics(self):
+        now = datetime.utcnow()
+        with app.app_context():
+            try:
+                WorkerMetrics.put(self._worker_id[:64], now, metrics.snapshot(),
+                                  now - timedelta(seconds=self.METRICS_MAX_AGE_S))
+            finally:
+                db.session.remove()
+
+    def _metrics_greenlet_main(self):
+        while True:
+            try:
+                self._flush_metrics()
+            except Exception:
+                logger.exception('Failed to publish metrics')
+            gevent.sleep(self.METRICS_FLUSH_S)
+
+    def all_metrics(self):
+        # Every worker's latest metrics, with this worker's current ones
+        since = datetime.utcnow() - timedelta(seconds=self.METRICS_MAX_AGE_S)
+        with app.app_context():
+            snapshots = WorkerMetrics.get_since(since)
+        snapshots[self._worker_id[:64]] = metrics.snapshot()
+        return snapshots
 
     def make_calendar(self, char_id, token):
-        cal_api = discovery.build('calendar', 'v3', credentials=token)
-        response = cal_api.calendars().insert(body={'summary': 'EVE POS events'}).execute()
+        with google_api.service(char_id, token, 'calendar', 'v3') as cal_api:
+            response = cal_api.calendars().insert(body={'summary': 'EVE POS events'}).execute()
         cal_id = response['id']
         Settings.set(char_id, Settings.CALENDAR, cal_id)
+        Settings.set(char_id, Settings.SYNC_TOKEN, None)
+        # Events recorded for the old calendar aren't in this one
+        CalendarEvent.delete_for_char(char_id)
         return cal_id
 
-    def run_for_all(self):
+    def run_for_all(self, job=None):
         with app.app_context():
             # Get all enabled towers (to figure out what keys we need)
-            enabled_towers = EnabledTowers.query.all()
-            char_ids = list(set(e.char_id for e in enabled_towers))
+            char_ids = EnabledTowers.get_char_ids()
+            if job is not None:
+                job.started(len(char_ids))
 
             logger.info("Starting update run")
-            greenlets = [self.run_for_char(char_id) for char_id in char_ids]
+            # Forced runs want the latest feed, which costs a 304 if it
+            # hasn't changed. Each run only looks at its own towers.
+            with metrics.RUN_PHASE_SECONDS.time(phase='posmon'):
+                towers = Tower.fetch_shared()
+            runs = CalendarServiceRun.load(char_ids, towers, self.limiter)
+            greenlets = [self._spawn_run(char_id, towers, self._pool.start, runs[char_id], job)
+                         for char_id in char_ids]
+            skipped = 0
             for char_id, greenlet in zip(char_ids, greenlets):
                 greenlet.join()
                 if greenlet.successful():
                     logger.debug("Update run succeeded for char id %s", char_id)
+                    skipped += greenlet.value.skipped
                 else:
                     logger.warn("Update run failed for char id %s: %s", char_id,
                                 greenlet.exception)
-            logger.info("Update run done")
-
-    def run_for_char(self, char_id):
-        def _run():
-            with self._locks[char_id]:
-                CalendarServiceRun(char_id).run()
-        with app.app_context():
-            return gevent.spawn(_run)
+            logger.info("Update run done, skipped %d of %d characters", skipped, len(char_ids))
+
+    def _spawn_run(self, char_id, towers, start, run=None, job=None, lease=None):
+        # At most one run per character executes at a time, with at most one
+        # more queued behind it. Requests made while a run is queued join it,
+        # since it will see their changes anyway. Runs claim the character's
+        # lease before starting, unless given one the scheduler claimed.
+        runs = self._runs.get(char_id)
+        if runs is None:
+            runs = self._runs[char_id] = _CharRuns()
+        if lease is not None:
+            runs.lease = lease
+
+        if runs.queued is not None:
+            greenlet = runs.queued
+            if job is not None:
+                runs.jobs.append(job)
+        else:
+            previous = runs.running
+            jobs = [job] if job is not None else []
+
+            def _run():
+                if previous is not None:
+                    previous.join()
+                    runs.running, runs.queued, runs.jobs = runs.queued, None, []
+                for j in jobs:
+                    if j.char_id is not None:
+                        j.started()
+                waited = self._wait_for_lease(char_id, runs)
+                # A preloaded run that had to wait for another run of the same
+                # character would work from stale rows, so it reloads them
+                current = run
+                if current is None or previous is not None or waited:
+                    current = CalendarServiceRun.load([char_id], towers, self.limiter)[char_id]
+                return current.run()
+
+            def _finished(greenlet):
+                if runs.running is greenlet:
+                    runs.running = None
+                if runs.running is None and runs.queued is None:
+                    self._runs.pop(char_id, None)
+                    if runs.lease is not None:
+                        self._release(char_id, *runs.lease)
+
+            # The state is updated before starting, as starting may yield
+            greenlet = gevent.Greenlet(_run)
+            greenlet.link(_finished)
+            if previous is None:
+                runs.running = greenlet
+            else:
+                runs.queued = greenlet
+                runs.jobs = jobs
+            with app.app_context():
+                start(greenlet)
+
+        if job is not None:
+            greenlet.link(functools.partial(job.finished, char_id))
+        return greenlet
+
+    def run_for_char(self, char_id, towers=None):
+        return self._spawn_run(char_id, towers, gevent.Greenlet.start)
+
+    def _submit(self, key, start):
+        # Jobs that haven't started yet are shared by later submissions
+        job = self._pending_jobs.get(key)
+        if job is not None and job.status == 'queued':
+            return job
+        job = Job(key)
+        self._jobs.set(job.id, job)
+        self._pending_jobs[key] = job
+
+        def _done(greenlet):
+            if self._pending_jobs.get(key) is job:
+                del self._pending_jobs[key]
+            if not greenlet.successful():
+                job.status = 'failed'
+        start(job).link(_done)
+        return job
+
+    def submit_char(self, char_id):
+        return self._submit(char_id, lambda job: self._spawn_run(
+            char_id, None, gevent.Greenlet.start, job=job))
+
+    def submit_all(self):
+        return self._submit(None, lambda job: gevent.spawn(self.run_for_all, job))
+
+    def get_job(self, job_id):
+        return self._jobs.get(job_id)
 
     def start(self):
         if self._greenlet:
             return
         self._greenlet = gevent.spawn(self._greenlet_main)
+        self._token_greenlet = gevent.spawn(self._token_greenlet_main)
+        self._metrics_greenlet = gevent.spawn(self._metrics_greenlet_main)
 
     def stop(self):
         if self._greenlet:
             self._greenlet.kill()
             self._greenlet = None
+        if self._token_greenlet:
+            self._token_greenlet.kill()
+            self._token_greenlet = None
+        if self._metrics_greenlet:
+            self._metrics_greenlet.kill()
+            self._metrics_greenlet = None
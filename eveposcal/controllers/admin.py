@@ -1,9 +1,28 @@
+import hmac
+
+from flask import Response, request
+
 from .base import auth_required
+from .. import metrics
 from ..app import app
 
 
 @app.route('/admin/force')
 @auth_required
 def get():
-    app.cal_service.run_for_all()
-    return 'OK'
+    return app.cal_service.submit_all().id
+
+
+def _render_metrics():
+    return Response(metrics.render(app.cal_service.all_metrics()),
+                    mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/admin/metrics')
+def get_metrics():
+    # Scrapers can't log in, so they send METRICS_TOKEN as a bearer token
+    token = app.config['METRICS_TOKEN']
+    header = request.headers.get('Authorization', '').encode('utf-8')
+    if token and hmac.compare_digest(header, 'Bearer ' + token.encode('utf-8')):
+        return _render_metrics()
+    return auth_required(_render_metrics)()
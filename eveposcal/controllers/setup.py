@@ -1,26 +1,43 @@
+import gevent
+import hashlib
+import json
 import logging
-from flask import g, render_template, redirect, request, session, url_for
+from flask import (Markup, abort, g, jsonify, make_response, render_template, redirect,
+                   request, session, url_for)
 
-from googleapiclient import discovery
 from googleapiclient.errors import HttpError
 
 from .base import auth_required, check_referrer
+from .. import google_api
 from ..app import app, db
+from ..cache import TTLCache
+from ..calendar_service import format_reminders, parse_reminders
 from ..model.db import EnabledTowers, Settings, Token
 from ..model.posmon import Tower
 
 
 logger = logging.getLogger(__name__)
 
+# How long the home page waits on Google and posmon before rendering
+# whatever it has
+HOME_TIMEOUT_S = 3
+
+# char_id -> Google+ profile
+_profiles = TTLCache(1000, ttl=10 * 60)
+
+# (posmon snapshot version, enabled towers version) -> rendered towers.html
+_tower_tables = TTLCache(100)
+
+# Templates the home page is rendered from, which its ETags cover
+HOME_TEMPLATES = ('base.html', 'home.html', 'towers.html')
+_template_version = []
+
 
 @app.route('/config/set_poses', methods=('POST',))
 @auth_required
 def config_set_poses():
-    EnabledTowers.query.filter(EnabledTowers.char_id == g.char_id).delete()
-    for arg, value in request.form.iteritems():
-        if arg.isdigit():
-            enable = EnabledTowers(char_id=g.char_id, orbit_id=int(arg))
-            db.session.add(enable)
+    EnabledTowers.replace_for_char(g.char_id, [int(arg) for arg in request.form.iterkeys()
+                                               if arg.isdigit()])
     db.session.commit()
 
     # Run a background update pass
@@ -30,28 +47,122 @@ def config_set_poses():
     return redirect(url_for('home'))
 
 
+@app.route('/config/set_reminders', methods=('POST',))
+@auth_required
+def config_set_reminders():
+    try:
+        reminders = parse_reminders(request.form.get('reminders', ''))
+    except ValueError:
+        abort(400)
+    Settings.set(g.char_id, Settings.REMINDERS, ','.join(str(r) for r in reminders))
+    db.session.commit()
+
+    # Run a background update pass
+    app.cal_service.run_for_char(g.char_id)
+
+    return redirect(url_for('home'))
+
+
+def _get_person(char_id, token):
+    person = _profiles.get(char_id)
+    if person is None:
+        try:
+            with google_api.service(char_id, token, 'plus', 'v1') as api:
+                person = api.people().get(userId='me').execute()
+            # Saves the token if it had to be refreshed
+            db.session.commit()
+        except Exception:
+            logger.warn('Failed to fetch Google profile for char_id=%s', char_id, exc_info=True)
+            return None
+        finally:
+            db.session.remove()
+        _profiles.set(char_id, person)
+    return person
+
+
+def _get_towers():
+    try:
+        return Tower.fetch_shared(app.config['POSMON_MAX_AGE_S'])
+    except Exception:
+        logger.warn('Failed to fetch towers', exc_info=True)
+        return None
+
+
+def _get_template_version():
+    if not _template_version:
+        digest = hashlib.sha1()
+        for name in HOME_TEMPLATES:
+            source = app.jinja_env.loader.get_source(app.jinja_env, name)[0]
+            digest.update(source.encode('utf-8'))
+        _template_version.append(digest.hexdigest())
+    return _template_version[0]
+
+
+def _render_towers(towers, enabled, enabled_version):
+    # The tower table is the bulk of the page, and is the same for everyone
+    # with the same towers enabled until the feed changes
+    key = (towers.version, enabled_version)
+    html = _tower_tables.get(key)
+    if html is None:
+        html = render_template('towers.html', towers=towers.by_orbit_name(), enabled=enabled)
+        if towers.version is not None:
+            _tower_tables.set(key, html)
+    return Markup(html)
+
+
 @app.route('/')
 @auth_required
 def home():
-    # Check for valid Google token
     token = Token.get_google_oauth(g.char_id)
-    person = None
-    if token:
-        api = discovery.build('plus', 'v1', credentials=token)
-        person = api.people().get(userId='me').execute()
-
-    # Check for selected POSes
     enabled = set(e.orbit_id for e in EnabledTowers.get_for_char(g.char_id))
-    towers = Tower.fetch_all().values()
-    towers.sort(key=lambda t: t.orbit_name)
-
+    reminders = Settings.get(g.char_id, Settings.REMINDERS)
+    if reminders is None:
+        reminders = app.config['DEFAULT_REMINDERS_S']
+    else:
+        reminders = [int(r) for r in reminders.split(',')]
     db.session.commit()
 
-    return render_template('home.html',
-                           char_name=session['char_name'],
-                           enabled=enabled,
-                           person=person,
-                           towers=towers)
+    # Look up the Google profile and towers concurrently. Lookups that don't
+    # finish in time keep running (and fill their caches for the next page
+    # load), but the page is rendered without them.
+    person_job = gevent.spawn(_get_person, g.char_id, token) if token else None
+    towers_job = gevent.spawn(_get_towers)
+    gevent.joinall([job for job in (person_job, towers_job) if job is not None],
+                   timeout=HOME_TIMEOUT_S)
+
+    # Finished greenlets are falsy, so check for None explicitly
+    person = person_job.value if person_job is not None else None
+    towers = towers_job.value
+
+    # The page only changes with what it's rendered from, so browsers that
+    # have it already get a 304 without it being rendered again
+    enabled_version = hashlib.sha1(','.join(str(o) for o in sorted(enabled))).hexdigest()
+    etag = hashlib.sha1(json.dumps([
+        _get_template_version(),
+        session['char_name'],
+        token is not None,
+        person and person['displayName'],
+        reminders,
+        towers is not None and towers.version,
+        enabled_version,
+    ])).hexdigest()
+    if towers is not None and towers.version is None:
+        etag = None
+    if etag is not None and request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = make_response(render_template(
+            'home.html',
+            char_name=session['char_name'],
+            reminders=format_reminders(reminders),
+            connected=token is not None,
+            person=person,
+            towers_html=(None if towers is None
+                         else _render_towers(towers, enabled, enabled_version))))
+    if etag is not None:
+        response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 
 @app.route('/reset')
@@ -63,13 +174,13 @@ def reset():
     token = Token.get_google_oauth(g.char_id)
     if token is None:
         return "This only works after you've linked your Google Calendar API token"
-    cal_api = discovery.build('calendar', 'v3', credentials=token)
 
     # Delete calendar linked to account
     cal_id = Settings.get(g.char_id, Settings.CALENDAR)
     if cal_id:
         try:
-            cal_api.calendars().delete(calendarId=cal_id).execute()
+            with google_api.service(g.char_id, token, 'calendar', 'v3') as cal_api:
+                cal_api.calendars().delete(calendarId=cal_id).execute()
         except HttpError:
             logger.debug("Failed to delete calendar", exc_info=True)
 
@@ -77,7 +188,16 @@ def reset():
     app.cal_service.make_calendar(g.char_id, token)
     db.session.commit()
 
-    # Run synchronous update pass
-    app.cal_service.run_for_char(g.char_id).join()
+    # Run a background update pass
+    app.cal_service.submit_char(g.char_id)
 
     return redirect(url_for('home'))
+
+
+@app.route('/jobs/<job_id>')
+@auth_required
+def job_status(job_id):
+    job = app.cal_service.get_job(job_id)
+    if job is None or job.char_id not in (None, g.char_id):
+        abort(404)
+    return jsonify(job.to_dict())
@@ -0,0 +1,50 @@
+# Number of character runs the update cycle executes concurrently
+CALENDAR_CONCURRENCY = 10
+
+# Token bucket for Google Calendar API requests (requests per second, and
+# how many may be sent in a burst)
+CALENDAR_RATE_LIMIT = 10
+CALENDAR_RATE_BURST = 50
+
+# How often a rate limited or failed (5xx) Calendar request is retried,
+# with exponential backoff, before the run is aborted
+CALENDAR_MAX_RETRIES = 5
+
+# How long before a tower runs out of fuel its events are, for characters
+# that haven't picked their own reminders
+DEFAULT_REMINDERS_S = [(2 * 24 + 1) * 60 * 60]
+
+# How old a posmon snapshot the scheduler may reuse for character runs
+POSMON_MAX_AGE_S = 5 * 60
+
+# Where the last posmon snapshot is kept across restarts (None to disable),
+# and how old a snapshot may be served when the feed can't be fetched
+POSMON_CACHE_PATH = None
+POSMON_MAX_STALENESS_S = 6 * 60 * 60
+
+# How often posmon is assumed to refresh a tower until two of its cache_ts
+# have been seen, and how late a refresh may show up in the feed. The feed
+# is checked when the next refresh of a subscribed tower is due, but at most
+# every POSMON_CHECK_MIN_S and at least every POSMON_CHECK_MAX_S.
+POSMON_CADENCE_S = 60 * 60
+POSMON_CHECK_GRACE_S = 5 * 60
+POSMON_CHECK_MIN_S = 60
+POSMON_CHECK_MAX_S = 60 * 60
+
+# Keep-alive connections kept open to the posmon server
+POSMON_POOL_SIZE = 10
+
+# Characters whose authorized Google API connections are kept for reuse,
+# and the socket timeout for Google API requests
+GOOGLE_HTTP_CACHE_SIZE = 1000
+GOOGLE_HTTP_TIMEOUT_S = 60
+
+# Where Google API discovery documents are fetched from, and the directory
+# they are cached in across restarts (None to only cache in memory)
+DISCOVERY_URI = 'https://www.googleapis.com/discovery/v1/apis/{api}/{apiVersion}/rest'
+DISCOVERY_CACHE_DIR = None
+
+# Bearer token a metrics scraper sends to read /admin/metrics without a
+# login session (None to only allow logged in users). Any worker serves
+# every worker's metrics, labelled by worker.
+METRICS_TOKEN = None
@@ -0,0 +1,110 @@
+import httplib2
+import json
+import logging
+import os
+import tempfile
+import urlparse
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from googleapiclient import discovery
+from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest
+
+from .app import app
+
+logger = logging.getLogger(__name__)
+
+# (api, version) -> discovery document
+_documents = {}
+
+# (api, version) -> batch endpoint
+_batch_uris = {}
+
+# char_id -> (credentials, authorized Http, {(api, version): service}) not in
+# use, least recently used first. An Http's connections can't be shared
+# between greenlets, so entries are taken out while in use, and a character
+# whose entry is taken gets a fresh one.
+_http_cache = OrderedDict()
+
+
+def _fetch_document(api, version):
+    uri = app.config['DISCOVERY_URI'].format(api=api, apiVersion=version)
+    http = httplib2.Http(timeout=app.config['GOOGLE_HTTP_TIMEOUT_S'])
+    response, content = http.request(uri)
+    if response.status >= 400:
+        raise HttpError(response, content, uri=uri)
+    return content
+
+
+def get_document(api, version):
+    # Discovery documents are kept for the life of the process, and in
+    # DISCOVERY_CACHE_DIR (if set) across restarts
+    key = (api, version)
+    if key in _documents:
+        return _documents[key]
+
+    cache_dir = app.config['DISCOVERY_CACHE_DIR']
+    path = cache_dir and os.path.join(cache_dir, '%s.%s.json' % (api, version))
+    if path and os.path.exists(path):
+        with open(path, 'rb') as f:
+            document = f.read()
+    else:
+        document = _fetch_document(api, version)
+        if path:
+            try:
+                fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(document)
+                os.rename(tmp_path, path)
+            except (IOError, OSError):
+                logger.warn('Failed to save discovery document to %s', path, exc_info=True)
+    _documents[key] = document
+    return document
+
+
+def _checkout(char_id, creds):
+    # Reuses the character's idle authorized Http (and so its keep-alive
+    # connections and built services) if its token is unchanged
+    entry = _http_cache.pop(char_id, None)
+    if entry is not None and entry[0].to_json() == creds.to_json():
+        # Refreshes must be saved through the caller's (current) session
+        entry[0].set_store(creds.store)
+        return entry
+    http = httplib2.Http(timeout=app.config['GOOGLE_HTTP_TIMEOUT_S'])
+    return (creds, creds.authorize(http), {})
+
+
+def _checkin(char_id, entry):
+    _http_cache.pop(char_id, None)
+    _http_cache[char_id] = entry
+    while len(_http_cache) > app.config['GOOGLE_HTTP_CACHE_SIZE']:
+        _http_cache.popitem(last=False)
+
+
+@contextmanager
+def service(char_id, creds, api, version):
+    # Yields a service object for the character, which only the calling
+    # greenlet may use until the block exits. Its Http is kept for reuse
+    # unless the block raised, as its connection may be left mid-request.
+    entry = _checkout(char_id, creds)
+    services = entry[2]
+    svc = services.get((api, version))
+    if svc is None:
+        svc = discovery.build_from_document(get_document(api, version), http=entry[1])
+        services[(api, version)] = svc
+    yield svc
+    _checkin(char_id, entry)
+
+
+def new_batch(api, version, callback=None):
+    # BatchHttpRequest defaults to the global batch endpoint, which Google no
+    # longer serves; each API has its own, named in its discovery document
+    key = (api, version)
+    batch_uri = _batch_uris.get(key)
+    if batch_uri is None:
+        document = json.loads(get_document(api, version))
+        batch_uri = urlparse.urljoin(document['rootUrl'],
+                                     document.get('batchPath', 'batch/%s/%s' % key))
+        _batch_uris[key] = batch_uri
+    return BatchHttpRequest(callback=callback, batch_uri=batch_uri)
@@ -28,6 +28,7 @@ def setup_app():
 
     # Set up database schema
     db.create_all()
+    db_model.upgrade_schema()
     db.session.commit()
 
 def main():
@@ -0,0 +1,126 @@
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+
+class _Metric(object):
+    TYPE = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        REGISTRY[name] = self
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    @staticmethod
+    def _escape(value):
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def _format(self, suffix, key, value, worker=None):
+        name = self.name + suffix
+        pairs = zip(self.labels, key)
+        if worker is not None:
+            pairs.append(('worker', worker))
+        if pairs:
+            name += '{%s}' % ','.join('%s="%s"' % (label, self._escape(v)) for label, v in pairs)
+        return '%s %r' % (name, float(value))
+
+    def series(self):
+        # (suffix, label values, value) for each sample
+        raise NotImplementedError
+
+    def samples(self):
+        for suffix, key, value in self.series():
+            yield self._format(suffix, key, value)
+
+    def render(self, snapshots=None):
+        # Renders this process's samples, or those of every worker in
+        # snapshots ({worker: snapshot()}) labelled with their worker
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.TYPE)]
+        if snapshots is None:
+            lines.extend(self.samples())
+        else:
+            for worker, snapshot in sorted(snapshots.iteritems()):
+                for suffix, key, value in snapshot.get(self.name, ()):
+                    lines.append(self._format(suffix, key, value, worker))
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    TYPE = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super(Counter, self).__init__(name, help, labels)
+        self._values = defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        self._values[self._key(labels)] += amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def series(self):
+        for key, value in sorted(self._values.iteritems()):
+            yield '', key, value
+
+
+class Summary(_Metric):
+    # Only tracks count and sum, which is enough for rates and averages
+    TYPE = 'summary'
+
+    def __init__(self, name, help, labels=()):
+        super(Summary, self).__init__(name, help, labels)
+        self._counts = defaultdict(int)
+        self._sums = defaultdict(float)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        self._counts[key] += 1
+        self._sums[key] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def series(self):
+        for key in sorted(self._counts):
+            yield '_count', key, self._counts[key]
+            yield '_sum', key, self._sums[key]
+
+
+REGISTRY = OrderedDict()
+
+
+def snapshot():
+    # This process's samples as plain lists, so they can be stored as JSON
+    return {name: [[suffix, list(key), value] for suffix, key, value in metric.series()]
+            for name, metric in REGISTRY.iteritems()}
+
+
+def render(snapshots=None):
+    # Prometheus text exposition format. Each process only counts its own
+    # runs, so snapshots ({worker: snapshot()}) lets one of them report
+    # every worker's samples, with a worker label.
+    return ''.join(metric.render(snapshots) + '\n' for metric in REGISTRY.itervalues())
+
+
+RUN_PHASE_SECONDS = Summary('eveposcal_run_phase_seconds',
+                            'Time spent in each phase of a calendar run', ['phase'])
+RUNS = Counter('eveposcal_runs_total', 'Calendar runs by result', ['result'])
+RUN_ABORTS = Counter('eveposcal_run_aborts_total', 'Aborted calendar runs by reason', ['code'])
+API_CALLS = Counter('eveposcal_calendar_api_calls_total',
+                    'Calendar API calls, counting each call in a batch', ['method'])
+API_REQUESTS = Counter('eveposcal_calendar_api_requests_total',
+                       'HTTP requests made to the Calendar API', ['kind'])
+API_RETRIES = Counter('eveposcal_calendar_api_retries_total',
+                      'Times Calendar API requests were retried after backing off')
+EVENTS_UNCHANGED = Counter('eveposcal_events_unchanged_total',
+                           'Event updates skipped because the event was close enough')
@@ -1,25 +1,73 @@
+import calendar
+import gevent
+import json
+import uuid
 from contextlib import contextmanager
+from datetime import datetime, timedelta
 
 from oauth2client.client import OAuth2Credentials, Storage
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
 
 from ..app import db
+from ..cache import TTLCache
 
 
 class CalendarEvent(db.Model):
-    __tablename__ = 'calendar_event'
+    __tablename__ = 'calendar_reminder'
+
+    # How long before fuel ran out events were made before reminders could
+    # be configured, which is what rows from the old calendar_event table
+    # are migrated to
+    LEGACY_REMINDER_S = (2 * 24 + 1) * 60 * 60
 
     char_id = db.Column(db.Integer, primary_key=True)
     orbit_id = db.Column(db.Integer, primary_key=True)
+    # Seconds before the tower runs out of fuel
+    reminder_s = db.Column(db.Integer, primary_key=True, autoincrement=False)
     event_id = db.Column(db.String(256))
+    # Last known state of the event in Google Calendar
+    start = db.Column(db.DateTime)
+    sequence = db.Column(db.Integer)
+    # Fingerprint of the last event arguments pushed to Google
+    fingerprint = db.Column(db.String(40))
 
     @classmethod
     def delete(cls, char_id, orbit_id):
         cls.query.filter_by(char_id=char_id, orbit_id=orbit_id).delete()
 
+    @classmethod
+    def delete_for_char(cls, char_id):
+        cls.query.filter_by(char_id=char_id).delete(synchronize_session=False)
+
+    @classmethod
+    def bulk_delete(cls, char_id, keys):
+        # keys are (orbit_id, reminder_s) pairs, deleted with one statement
+        # per reminder
+        by_reminder = {}
+        for orbit_id, reminder_s in keys:
+            by_reminder.setdefault(reminder_s, []).append(orbit_id)
+        for reminder_s, orbit_ids in by_reminder.iteritems():
+            cls.query.filter(cls.char_id == char_id, cls.reminder_s == reminder_s,
+                             cls.orbit_id.in_(orbit_ids)).delete(synchronize_session=False)
+
+    @classmethod
+    def bulk_upsert(cls, char_id, rows):
+        # rows are dicts of column values; existing rows with the same key
+        # are replaced
+        rows = list(rows)
+        if rows:
+            cls.bulk_delete(char_id, [(row['orbit_id'], row['reminder_s']) for row in rows])
+            db.session.execute(cls.__table__.insert(), rows)
+
     @classmethod
     def get_for_char(cls, char_id):
         return cls.query.filter_by(char_id=char_id).all()
 
+    @classmethod
+    def get_for_chars(cls, char_ids):
+        return cls.query.filter(cls.char_id.in_(char_ids)).all()
+
 
 class EnabledTowers(db.Model):
     __tablename__ = 'enabled_tower'
@@ -27,15 +75,250 @@ class EnabledTowers(db.Model):
     char_id = db.Column(db.Integer, primary_key=True)
     orbit_id = db.Column(db.Integer, primary_key=True)
 
+    __table_args__ = (
+        db.Index('ix_enabled_tower_orbit_id', 'orbit_id'),
+    )
+
+    @classmethod
+    def get_char_ids(cls):
+        # Answered from the primary key index, without loading any rows
+        return [char_id for (char_id,) in db.session.query(cls.char_id).distinct()]
+
+    @classmethod
+    def get_orbit_ids(cls):
+        return [orbit_id for (orbit_id,) in db.session.query(cls.orbit_id).distinct()]
+
+    @classmethod
+    def get_subscribers(cls, orbit_ids, chunk=500):
+        # orbit_id -> set of char_ids that enabled it, looked up through
+        # ix_enabled_tower_orbit_id
+        orbit_ids = list(orbit_ids)
+        result = {}
+        for i in xrange(0, len(orbit_ids), chunk):
+            rows = db.session.query(cls.orbit_id, cls.char_id).filter(
+                cls.orbit_id.in_(orbit_ids[i:i + chunk]))
+            for orbit_id, char_id in rows:
+                result.setdefault(orbit_id, set()).add(char_id)
+        return result
+
+    @classmethod
+    def replace_for_char(cls, char_id, orbit_ids):
+        cls.query.filter(cls.char_id == char_id).delete(synchronize_session=False)
+        rows = [{'char_id': char_id, 'orbit_id': orbit_id} for orbit_id in set(orbit_ids)]
+        if rows:
+            db.session.execute(cls.__table__.insert(), rows)
+
     @classmethod
     def get_for_char(cls, char_id):
         return cls.query.filter_by(char_id=char_id).all()
 
+    @classmethod
+    def get_for_chars(cls, char_ids):
+        return cls.query.filter(cls.char_id.in_(char_ids)).all()
+
+
+class RunLease(db.Model):
+    # When each character is next due for a scheduled run, and which worker
+    # (if any) currently holds it. Shared by every process and host using the
+    # database, so each character is synced by one of them.
+    __tablename__ = 'run_lease'
+
+    char_id = db.Column(db.Integer, primary_key=True)
+    due = db.Column(db.DateTime, nullable=False)
+    owner = db.Column(db.String(64))
+    expires = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_run_lease_due', 'due'),
+    )
+
+    @classmethod
+    def _unleased(cls, now):
+        return db.or_(cls.expires.is_(None), cls.expires < now)
+
+    @classmethod
+    def sync_members(cls, char_ids, due_for):
+        # Adds rows for new characters (due at due_for(char_id)) and drops
+        # characters that no longer have enabled towers
+        char_ids = set(char_ids)
+        existing = set(char_id for (char_id,) in db.session.query(cls.char_id))
+        removed = existing - char_ids
+        if removed:
+            cls.query.filter(cls.char_id.in_(removed)).delete(synchronize_session=False)
+        rows = [{'char_id': char_id, 'due': due_for(char_id)} for char_id in char_ids - existing]
+        try:
+            if rows:
+                db.session.execute(cls.__table__.insert(), rows)
+            db.session.commit()
+        except IntegrityError:
+            # Another worker added them first
+            db.session.rollback()
+
+    @classmethod
+    def claim(cls, owner, now, lease_until, limit):
+        # Claims up to limit due, unleased characters with a single
+        # conditional UPDATE, so concurrent workers never claim the same one
+        candidates = [char_id for (char_id,) in
+                      db.session.query(cls.char_id)
+                      .filter(cls.due <= now, cls._unleased(now))
+                      .order_by(cls.due).limit(limit)]
+        if not candidates:
+            return []
+        cls.query.filter(cls.char_id.in_(candidates), cls.due <= now,
+                         cls._unleased(now)).update({'owner': owner, 'expires': lease_until},
+                                                    synchronize_session=False)
+        claimed = [char_id for (char_id,) in
+                   db.session.query(cls.char_id).filter(cls.owner == owner)]
+        db.session.commit()
+        return claimed
+
+    @classmethod
+    def claim_char(cls, char_id, owner, now, lease_until):
+        # Claims char_id whether or not it is due (adding its row if the
+        # scheduler hasn't yet), unless another worker holds it
+        updated = cls.query.filter(cls.char_id == char_id, cls._unleased(now)).update(
+            {'owner': owner, 'expires': lease_until}, synchronize_session=False)
+        if not updated and db.session.query(cls.char_id).filter(
+                cls.char_id == char_id).first() is None:
+            try:
+                db.session.execute(cls.__table__.insert(), [
+                    {'char_id': char_id, 'due': now, 'owner': owner, 'expires': lease_until}])
+                updated = 1
+            except IntegrityError:
+                # Another worker added it first
+                db.session.rollback()
+                return False
+        db.session.commit()
+        return bool(updated)
+
+    @classmethod
+    def expedite(cls, char_ids, now, chunk=500):
+        # Makes char_ids due now. Leased characters are due again as soon as
+        # their current run finishes, as it may have started before whatever
+        # prompted this.
+        char_ids = list(char_ids)
+        for i in xrange(0, len(char_ids), chunk):
+            cls.query.filter(cls.char_id.in_(char_ids[i:i + chunk]),
+                             db.or_(cls.due > now, cls.owner.isnot(None))).update(
+                {'due': now}, synchronize_session=False)
+        db.session.commit()
+
+    @classmethod
+    def release(cls, char_id, owner, claimed_at, due):
+        # Keeps the character due at the time it was expedited to, if that
+        # happened after it was claimed
+        cls.query.filter(cls.char_id == char_id, cls.owner == owner).update(
+            {'due': db.case([(cls.due > claimed_at, cls.due)], else_=due),
+             'owner': None, 'expires': None}, synchronize_session=False)
+        db.session.commit()
+
+    @classmethod
+    def next_due(cls, now):
+        return db.session.query(db.func.min(cls.due)).filter(cls._unleased(now)).scalar()
+
+
+class ServiceLease(db.Model):
+    # Background tasks that only one worker should run at a time (such as
+    # token refreshes), and which worker holds each. The holder renews its
+    # lease each time it runs the task, and another worker takes over if it
+    # lets the lease expire.
+    __tablename__ = 'service_lease'
+
+    TOKEN_REFRESH = 'token_refresh'
+    SCHEMA_UPGRADE = 'schema_upgrade'
+
+    name = db.Column(db.String(32), primary_key=True)
+    owner = db.Column(db.String(64))
+    expires = db.Column(db.DateTime)
+
+    @classmethod
+    def acquire(cls, name, owner, now, lease_until):
+        # Takes or renews the lease with a conditional UPDATE (or adds its
+        # row), so concurrent workers never both get it
+        updated = cls.query.filter(
+            cls.name == name,
+            db.or_(cls.owner == owner, cls.expires.is_(None), cls.expires < now)).update(
+            {'owner': owner, 'expires': lease_until}, synchronize_session=False)
+        if not updated and db.session.query(cls.name).filter(cls.name == name).first() is None:
+            try:
+                db.session.execute(cls.__table__.insert(),
+                                   [{'name': name, 'owner': owner, 'expires': lease_until}])
+                updated = 1
+            except IntegrityError:
+                # Another worker added it first
+                db.session.rollback()
+                return False
+        db.session.commit()
+        return bool(updated)
+
+
+class WorkerMetrics(db.Model):
+    # The latest metrics of each worker process, so whichever worker a
+    # scraper reaches can report all of them
+    __tablename__ = 'worker_metrics'
+
+    worker = db.Column(db.String(64), primary_key=True)
+    updated = db.Column(db.DateTime, nullable=False)
+    samples = db.Column(db.Text, nullable=False)
+
+    @classmethod
+    def put(cls, worker, now, samples, expired_before):
+        # Also drops workers that stopped reporting
+        cls.query.filter(cls.updated < expired_before).delete(synchronize_session=False)
+        db.session.merge(cls(worker=worker, updated=now, samples=json.dumps(samples)))
+        db.session.commit()
+
+    @classmethod
+    def get_since(cls, since):
+        return {obj.worker: json.loads(obj.samples)
+                for obj in cls.query.filter(cls.updated >= since)}
+
+
+class TowerHorizon(db.Model):
+    # When posmon is next expected to publish new data for each subscribed
+    # tower, going by how often its cache_ts has moved
+    __tablename__ = 'tower_horizon'
+
+    orbit_id = db.Column(db.Integer, primary_key=True)
+    cache_ts = db.Column(db.DateTime, nullable=False)
+    # Seconds between the last two cache_ts seen, if any
+    cadence = db.Column(db.Integer)
+    next_check = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_tower_horizon_next_check', 'next_check'),
+    )
+
+    @classmethod
+    def get_all(cls):
+        return {horizon.orbit_id: horizon for horizon in cls.query}
+
+    @classmethod
+    def bulk_delete(cls, orbit_ids, chunk=500):
+        orbit_ids = list(orbit_ids)
+        for i in xrange(0, len(orbit_ids), chunk):
+            cls.query.filter(cls.orbit_id.in_(orbit_ids[i:i + chunk])).delete(
+                synchronize_session=False)
+
+    @classmethod
+    def bulk_upsert(cls, rows):
+        rows = list(rows)
+        if rows:
+            cls.bulk_delete([row['orbit_id'] for row in rows])
+            db.session.execute(cls.__table__.insert(), rows)
+
+    @classmethod
+    def earliest(cls):
+        return db.session.query(db.func.min(cls.next_check)).scalar()
+
 
 class Settings(db.Model):
     __tablename__ = 'settings'
 
     CALENDAR = 0
+    SYNC_TOKEN = 1
+    # Comma separated seconds before fuel runs out to have events at
+    REMINDERS = 2
 
     char_id = db.Column(db.Integer, primary_key=True)
     key = db.Column(db.Integer, primary_key=True)
@@ -65,11 +348,17 @@ class Token(db.Model):
     kind = db.Column(db.String(10), primary_key=True)
     value = db.Column(db.VARBINARY(4096))
 
+    # char_id -> (stored value, decoded credentials). Entries expire with
+    # their access token, after which the stored value is decoded again.
+    _credentials = TTLCache(10000)
+
     class _Storage(Storage):
         def __init__(self, t):
             self._t = t
 
         def locked_get(self):
+            # The row may have been loaded by another greenlet's session
+            self._t = db.session.merge(self._t)
             db.session.refresh(self._t)
             creds = OAuth2Credentials.from_json(self._t.value)
             creds.set_store(self)
@@ -78,13 +367,22 @@ class Token(db.Model):
         def locked_put(self, creds):
             self._t.value = creds.to_json()
             db.session.merge(self._t)
+            Token._cache_credentials(self._t.char_id, self._t.value, creds)
 
         def locked_delete(self):
-            db.session.delete(self._t)
+            db.session.delete(db.session.merge(self._t))
+
+    @classmethod
+    def _cache_credentials(cls, char_id, value, creds):
+        expires = None
+        if creds.token_expiry is not None:
+            expires = calendar.timegm(creds.token_expiry.timetuple())
+        cls._credentials.set(char_id, (value, creds), expires)
 
     @classmethod
     def clear_google_oauth(cls, char_id):
         cls.query.filter(cls.char_id == char_id).filter(cls.kind == cls.GOOGLE_OAUTH).delete()
+        cls._credentials.pop(char_id)
 
     @classmethod
     def get_google_oauth(cls, char_id):
@@ -96,7 +394,12 @@ class Token(db.Model):
                                 cls.char_id.in_(char_ids)).all()
         result = {}
         for obj in objs:
-            creds = OAuth2Credentials.from_json(obj.value)
+            cached = cls._credentials.get(obj.char_id)
+            if cached is not None and cached[0] == obj.value:
+                creds = cached[1]
+            else:
+                creds = OAuth2Credentials.from_json(obj.value)
+                cls._cache_credentials(obj.char_id, obj.value, creds)
             creds.set_store(cls._Storage(obj))
             result[obj.char_id] = creds
         return result
@@ -105,6 +408,52 @@ class Token(db.Model):
     def set_google_oauth(cls, char_id, creds):
         obj = Token(char_id=char_id, kind=Token.GOOGLE_OAUTH, value=creds.to_json())
         db.session.merge(obj)
+        cls._credentials.pop(char_id)
+
+
+# How long the worker migrating legacy tables may take before another one
+# retries, and how often the others check whether it is done
+SCHEMA_LEASE_S = 10 * 60
+SCHEMA_POLL_S = 1
+
+
+def _has_table(name):
+    return name in inspect(db.engine).get_table_names()
+
+
+def upgrade_schema():
+    # create_all() only creates missing tables, so add any (nullable) columns
+    # and indexes introduced since a table was created
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                db.engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    table.name, column.name, column.type.compile(db.engine.dialect)))
+        existing = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine)
+
+    # Events used to be keyed by tower alone, all at the same reminder. Every
+    # worker upgrades at startup, so only the one holding the lease copies
+    # them, and the rest wait until it has dropped the old table.
+    owner = uuid.uuid4().hex
+    while _has_table('calendar_event'):
+        now = datetime.utcnow()
+        if not ServiceLease.acquire(ServiceLease.SCHEMA_UPGRADE, owner, now,
+                                    now + timedelta(seconds=SCHEMA_LEASE_S)):
+            gevent.sleep(SCHEMA_POLL_S)
+            continue
+        # The previous holder may have finished since the check above
+        if not _has_table('calendar_event'):
+            break
+        columns = ', '.join(c['name'] for c in inspect(db.engine).get_columns('calendar_event'))
+        with db.engine.begin() as conn:
+            conn.execute('INSERT INTO %s (%s, reminder_s) SELECT %s, %d FROM calendar_event' % (
+                CalendarEvent.__tablename__, columns, columns, CalendarEvent.LEGACY_REMINDER_S))
+            conn.execute('DROP TABLE calendar_event')
 
 
 @contextmanager
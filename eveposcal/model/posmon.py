@@ -1,45 +1,197 @@
+import hashlib
 import json
+import logging
+import os
+import pickle
 import requests
+import tempfile
+import time
 from datetime import datetime, timedelta
+from gevent.event import AsyncResult
+from requests.adapters import HTTPAdapter
 
 from ..app import app
 
+logger = logging.getLogger(__name__)
+
+
+class TowerSet(dict):
+    # Towers keyed by orbit_id. Snapshots are shared between callers, so they
+    # must be treated as read-only.
+    __slots__ = ('_by_orbit_name', 'version')
+
+    def __init__(self, *args, **kwargs):
+        super(TowerSet, self).__init__(*args, **kwargs)
+        self._by_orbit_name = None
+        # Hash of the feed a snapshot was parsed from, None for other sets
+        self.version = None
+
+    def subset(self, orbit_ids):
+        return TowerSet((orbit_id, self[orbit_id]) for orbit_id in orbit_ids if orbit_id in self)
+
+    def diff(self, other):
+        # orbit_ids of towers added, removed or changed since other
+        changed = set(self.viewkeys() ^ other.viewkeys())
+        for orbit_id, tower in self.iteritems():
+            old = other.get(orbit_id)
+            if old is not None and old.state() != tower.state():
+                changed.add(orbit_id)
+        return changed
+
+    def by_orbit_name(self):
+        if self._by_orbit_name is None:
+            self._by_orbit_name = sorted(self.itervalues(), key=lambda t: t.orbit_name)
+        return self._by_orbit_name
+
 
 class Tower(object):
+    __slots__ = ('name', 'orbit_id', 'orbit_name', 'corporation', 'cache_ts',
+                 'fuel_expiration')
+
     _posmon_url = None
+    _inflight = None
+    _snapshot = None
+    _snapshot_ts = 0
+    _etag = None
+    _last_modified = None
+    _cache_loaded = False
+    _session = None
 
     def __init__(self, json, cache_ts, corp):
-        self._json = json
-        self.cache_ts = cache_ts
+        # Only keep the fields we use, not the whole JSON blob
+        location = json['location']
+        self.name = json['name']
+        self.orbit_id = location['orbit_id']
+        self.orbit_name = location['orbit_name']
         self.corporation = corp
+        self.cache_ts = cache_ts
+        self.fuel_expiration = cache_ts + timedelta(hours=int(json['fuel']/json['fuel_per_hour']))
 
     def get_fuel_expiration(self):
-        time_left = timedelta(hours=int(self._json['fuel']/self._json['fuel_per_hour']))
-        return self.cache_ts + time_left
-
-    @property
-    def name(self):
-        return self._json['name']
-
-    @property
-    def orbit_id(self):
-        return self._json['location']['orbit_id']
+        return self.fuel_expiration
 
-    @property
-    def orbit_name(self):
-        return self._json['location']['orbit_name']
+    def state(self):
+        # Everything calendar events are made from
+        return (self.name, self.orbit_name, self.fuel_expiration)
 
     @classmethod
-    def fetch_all(cls):
-        result = {}
-        response = requests.get(app.config['POSMON_URL'])
-        for line in response.iter_lines():
+    def _get_session(cls):
+        if cls._session is None:
+            pool_size = app.config['POSMON_POOL_SIZE']
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            cls._session = requests.Session()
+            cls._session.mount('http://', adapter)
+            cls._session.mount('https://', adapter)
+        return cls._session
+
+    @staticmethod
+    def _parse_lines(lines):
+        # Builds towers one corporation line at a time, as the feed streams in
+        for line in lines:
             if not line or not line.startswith('{'):
                 continue
             obj = json.loads(line)
             corp = obj['corporation']
             start = datetime.strptime(obj['cache_ts'], '%Y-%m-%d %H:%M:%S')
             for tower_json in obj['towers']:
-                tower = Tower(tower_json, start, corp)
-                result[tower.orbit_id] = tower
-        return result
+                yield Tower(tower_json, start, corp)
+
+    @classmethod
+    def _load_cache(cls):
+        path = app.config['POSMON_CACHE_PATH']
+        if not path or not os.path.exists(path):
+            return
+        try:
+            with open(path, 'rb') as f:
+                ts, etag, last_modified, version, snapshot = pickle.load(f)
+            snapshot.version = version
+            cls._snapshot_ts, cls._etag, cls._last_modified, cls._snapshot = (
+                ts, etag, last_modified, snapshot)
+            logger.info('Loaded posmon snapshot from %s', path)
+        except Exception:
+            logger.warn('Failed to load posmon snapshot from %s', path, exc_info=True)
+
+    @classmethod
+    def _save_cache(cls):
+        path = app.config['POSMON_CACHE_PATH']
+        if not path:
+            return
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((cls._snapshot_ts, cls._etag, cls._last_modified,
+                             cls._snapshot.version, cls._snapshot), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+        except Exception:
+            logger.warn('Failed to save posmon snapshot to %s', path, exc_info=True)
+
+    @classmethod
+    def _revalidate(cls):
+        headers = {}
+        if cls._snapshot is not None:
+            if cls._etag:
+                headers['If-None-Match'] = cls._etag
+            if cls._last_modified:
+                headers['If-Modified-Since'] = cls._last_modified
+        response = cls._get_session().get(app.config['POSMON_URL'], headers=headers,
+                                          stream=True)
+        try:
+            if response.status_code == 304 and cls._snapshot is not None:
+                cls._snapshot_ts = time.time()
+                return cls._snapshot
+            response.raise_for_status()
+            digest = hashlib.sha1()
+
+            def _hashed(lines):
+                for line in lines:
+                    digest.update(line + '\n')
+                    yield line
+            snapshot = TowerSet((tower.orbit_id, tower)
+                                for tower in cls._parse_lines(_hashed(response.iter_lines())))
+            snapshot.version = digest.hexdigest()
+        finally:
+            response.close()
+        cls._snapshot = snapshot
+        cls._snapshot_ts = time.time()
+        cls._etag = response.headers.get('ETag')
+        cls._last_modified = response.headers.get('Last-Modified')
+        cls._save_cache()
+        return snapshot
+
+    @classmethod
+    def _fetch_snapshot(cls):
+        if not cls._cache_loaded:
+            cls._cache_loaded = True
+            cls._load_cache()
+        try:
+            return cls._revalidate()
+        except Exception:
+            # Fall back to the last good snapshot if it isn't too old
+            max_staleness = app.config['POSMON_MAX_STALENESS_S']
+            if cls._snapshot is None or time.time() - cls._snapshot_ts > max_staleness:
+                raise
+            logger.warn('Failed to fetch posmon feed, using snapshot from %s',
+                        datetime.utcfromtimestamp(cls._snapshot_ts), exc_info=True)
+            return cls._snapshot
+
+    @classmethod
+    def fetch_shared(cls, max_age=0):
+        # Concurrent callers share a single in-flight fetch, and the result is
+        # reused by callers willing to accept a snapshot up to max_age seconds
+        # old. Fetches are conditional, so an unchanged feed costs a 304. The
+        # returned TowerSet is shared, so callers must not modify it.
+        if cls._snapshot is not None and time.time() - cls._snapshot_ts <= max_age:
+            return cls._snapshot
+        if cls._inflight is not None:
+            return cls._inflight.get()
+        cls._inflight = inflight = AsyncResult()
+        try:
+            result = cls._fetch_snapshot()
+        except Exception as e:
+            inflight.set_exception(e)
+            raise
+        else:
+            inflight.set(result)
+            return result
+        finally:
+            cls._inflight = None
@@ -0,0 +1,29 @@
+import gevent
+import time
+from gevent.lock import Semaphore
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._lock = Semaphore()
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self, count=1):
+        # Waiters are served in order. A request for more than the burst size
+        # only waits for a full bucket and leaves it in debt, so the average
+        # rate still holds.
+        with self._lock:
+            self._refill()
+            needed = min(count, self.burst)
+            while self._tokens < needed:
+                gevent.sleep((needed - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= count
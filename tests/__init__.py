@@ -0,0 +1,73 @@
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from gevent.pywsgi import WSGIServer
+from oauth2client.client import OAuth2Credentials
+
+from eveposcal import default_config, google_api
+from eveposcal.app import app, db
+from eveposcal.model import db as db_model
+from eveposcal.model.posmon import Tower, TowerSet
+
+
+def make_credentials():
+    # Unexpired, so nothing ever tries to refresh them
+    return OAuth2Credentials('test-access-token', 'test-client', 'test-secret',
+                             'test-refresh-token', datetime.utcnow() + timedelta(days=30),
+                             'http://127.0.0.1:1/token', 'eveposcal-test')
+
+
+def make_towers(count, cache_ts=None, fuel_hours=100):
+    cache_ts = cache_ts or datetime.utcnow().replace(microsecond=0)
+    towers = TowerSet()
+    for i in xrange(count):
+        tower = Tower({'name': 'Tower %d' % i,
+                       'fuel': (fuel_hours + i) * 40,
+                       'fuel_per_hour': 40,
+                       'location': {'orbit_id': 1000 + i, 'orbit_name': 'Moon %d' % i}},
+                      cache_ts, 'Corp')
+        towers[tower.orbit_id] = tower
+    return towers
+
+
+class AppTestCase(unittest.TestCase):
+    # Runs each test in an app context with the default config, over an
+    # empty SQLite database
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        app.config.from_object(default_config)
+        app.config.update(
+            TESTING=True,
+            SECRET_KEY='test',
+            SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(self.tmp_dir, 'test.db'),
+        )
+        self._ctx = app.app_context()
+        self._ctx.push()
+        db.create_all()
+        db_model.upgrade_schema()
+
+        # Discovery documents and connections belong to whichever fake
+        # server the test started
+        google_api._documents.clear()
+        google_api._batch_uris.clear()
+        google_api._http_cache.clear()
+
+    def tearDown(self):
+        db.session.remove()
+        self._ctx.pop()
+        shutil.rmtree(self.tmp_dir)
+
+    def serve(self, application):
+        # Serves a WSGI application (such as one of bench.fakes) until the
+        # test finishes, and returns its URL
+        server = WSGIServer(('127.0.0.1', 0), application, log=None)
+        server.start()
+        self.addCleanup(server.stop)
+        return 'http://127.0.0.1:%d/' % (server.server_port,)
@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta
+
+from eveposcal import metrics
+from eveposcal.app import app
+from eveposcal.calendar_service import CalendarService
+from eveposcal.controllers import admin, auth
+from eveposcal.model.db import WorkerMetrics
+
+from . import AppTestCase
+
+# Routes the views use
+admin, auth
+
+
+class MetricsTest(AppTestCase):
+    def setUp(self):
+        super(MetricsTest, self).setUp()
+        app.config['METRICS_TOKEN'] = 'scrape-token'
+        app.cal_service = CalendarService()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        del app.cal_service
+        super(MetricsTest, self).tearDown()
+
+    def test_all_workers_are_reported(self):
+        now = datetime.utcnow()
+        WorkerMetrics.put('other:1', now, {
+            metrics.RUNS.name: [['', ['success'], 5]],
+            metrics.API_RETRIES.name: [['', [], 2]],
+        }, now)
+        WorkerMetrics.put('stopped:2', now - timedelta(hours=1),
+                          {metrics.RUNS.name: [['', ['success'], 1]]}, now - timedelta(days=1))
+        metrics.RUNS.inc(result='error')
+
+        response = self.client.get('/admin/metrics',
+                                   headers={'Authorization': 'Bearer scrape-token'})
+        self.assertEqual(response.status_code, 200)
+        lines = response.data.splitlines()
+        worker = app.cal_service._worker_id
+        self.assertIn('eveposcal_runs_total{result="success",worker="other:1"} 5.0', lines)
+        self.assertIn('eveposcal_calendar_api_retries_total{worker="other:1"} 2.0', lines)
+        self.assertIn('eveposcal_runs_total{result="error",worker="%s"} %r' % (
+            worker, float(metrics.RUNS.get(result='error'))), lines)
+        self.assertNotIn('stopped:2', response.data)
+
+        # This worker's metrics reach the others through the database
+        app.cal_service._flush_metrics()
+        self.assertIn(worker, WorkerMetrics.get_since(datetime.utcnow() - timedelta(minutes=1)))
+
+    def test_scrapers_need_the_token(self):
+        for headers in ({}, {'Authorization': 'Bearer wrong'}):
+            response = self.client.get('/admin/metrics', headers=headers)
+            self.assertEqual(response.status_code, 302)
+
+        app.config['METRICS_TOKEN'] = None
+        response = self.client.get('/admin/metrics', headers={'Authorization': 'Bearer '})
+        self.assertEqual(response.status_code, 302)
+
+        with self.client.session_transaction() as session:
+            session['char_id'] = 1
+        response = self.client.get('/admin/metrics')
+        self.assertEqual(response.status_code, 200)
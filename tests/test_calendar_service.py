@@ -0,0 +1,204 @@
+import gevent
+import json
+import unittest
+from datetime import datetime, timedelta
+
+from bench.fakes import FakeCalendar
+from eveposcal import google_api
+from eveposcal.app import app, db
+from eveposcal.calendar_service import (CalendarService, CalendarServiceRun, RunAbortedException,
+                                        format_reminders, parse_reminders)
+from eveposcal.model.db import CalendarEvent, EnabledTowers, RunLease, Settings, Token
+
+from . import AppTestCase, make_credentials, make_towers
+
+CHAR_ID = 1
+CAL_ID = 'cal1'
+
+
+class RemindersTest(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(parse_reminders('2d, 7d,6h'), [7 * 86400, 2 * 86400, 6 * 3600])
+        self.assertEqual(parse_reminders('1d1h30m'), [(25 * 60 + 30) * 60])
+        self.assertEqual(format_reminders(parse_reminders('7d, 2d1h, 30m')), '7d, 2d1h, 30m')
+
+    def test_parse_rejects_invalid(self):
+        for text in ('', '2x', '0d', '1d,,2d', '1d,2d,3d,4d,5d,6d', '31d', '99999999d'):
+            self.assertRaises(ValueError, parse_reminders, text)
+        self.assertEqual(parse_reminders('30d'), [CalendarServiceRun.MAX_REMINDER_S])
+
+
+class FakeCalendarTestCase(AppTestCase):
+    # Runs against bench.fakes.FakeCalendar, which only accepts batches on
+    # the per-API endpoint named in its discovery document
+
+    def setUp(self):
+        super(FakeCalendarTestCase, self).setUp()
+        self._serve_calendar(FakeCalendar(seed=0))
+        Token.set_google_oauth(CHAR_ID, make_credentials())
+        Settings.set(CHAR_ID, Settings.CALENDAR, CAL_ID)
+        db.session.commit()
+
+    def _serve_calendar(self, calendar):
+        self.calendar = calendar
+        url = self.serve(calendar)
+        app.config['DISCOVERY_URI'] = url + 'discovery/v1/apis/{api}/{apiVersion}/rest'
+        google_api._documents.clear()
+        google_api._batch_uris.clear()
+        google_api._http_cache.clear()
+
+    def _enable(self, orbit_ids):
+        EnabledTowers.replace_for_char(CHAR_ID, orbit_ids)
+        db.session.commit()
+        self.calendar.reset_stats()
+
+    def _events(self, cal_id=CAL_ID):
+        return {evt['id']: evt for evt in self.calendar._calendars[cal_id].itervalues()
+                if evt['status'] == 'confirmed'}
+
+    def _stored(self):
+        return {(evt.orbit_id, evt.reminder_s): evt for evt in CalendarEvent.get_for_char(CHAR_ID)}
+
+
+class RejectingCalendar(FakeCalendar):
+    # Fails every batch after the first ok_batches with a 400
+    ok_batches = 1
+
+    def __call__(self, environ, start_response):
+        if environ['PATH_INFO'] == '/batch/calendar/v3' and not self.ok_batches:
+            self.stats['batches'] += 1
+            start_response('400 Bad Request', [('Content-Type', 'application/json')])
+            return [json.dumps(self._error(400, 'badRequest')[1])]
+        if environ['PATH_INFO'] == '/batch/calendar/v3':
+            self.ok_batches -= 1
+        return super(RejectingCalendar, self).__call__(environ, start_response)
+
+
+class CalendarServiceRunTest(FakeCalendarTestCase):
+    def _run(self, towers, orbit_ids=None):
+        self._enable(towers if orbit_ids is None else orbit_ids)
+        run = CalendarServiceRun.load([CHAR_ID], towers)[CHAR_ID]
+        run.MAX_BACKOFF_S = 0
+        return run.run()
+
+    def test_changes_are_batched(self):
+        towers = make_towers(CalendarServiceRun.BATCH_SIZE + 10)
+        self.assertFalse(self._run(towers).skipped)
+        stats = self.calendar.stats
+        self.assertEqual(stats['calls']['calendar.events.insert'], len(towers))
+        self.assertEqual(stats['batches'], 2)
+        # calendars.get and events.list, then the two batches
+        self.assertEqual(stats['http_requests'], 4)
+
+        events = self._events()
+        stored = self._stored()
+        self.assertEqual(len(events), len(towers))
+        self.assertEqual(set(evt.event_id for evt in stored.itervalues()), set(events))
+
+        # Refueled towers move every event, with updates rather than inserts
+        self._run(make_towers(len(towers), fuel_hours=200))
+        stats = self.calendar.stats
+        self.assertEqual(stats['calls']['calendar.events.update'], len(towers))
+        self.assertNotIn('calendar.events.insert', stats['calls'])
+        self.assertEqual(stats['batches'], 2)
+        self.assertEqual(set(self._events()), set(events))
+
+    def test_removed_towers_are_deleted(self):
+        towers = make_towers(CalendarServiceRun.BATCH_SIZE + 10)
+        self._run(towers)
+        kept = sorted(towers)[:5]
+        self.assertFalse(self._run(towers, kept).skipped)
+        stats = self.calendar.stats
+        self.assertEqual(stats['calls']['calendar.events.delete'], len(towers) - len(kept))
+        self.assertEqual(stats['batches'], 2)
+        self.assertEqual(len(self._events()), len(kept))
+        self.assertEqual(sorted(orbit_id for orbit_id, _ in self._stored()), kept)
+
+    def test_out_of_range_reminders_are_ignored(self):
+        Settings.set(CHAR_ID, Settings.REMINDERS, '%d,3600' % (99999999 * 86400,))
+        towers = make_towers(2)
+        self.assertFalse(self._run(towers).skipped)
+        self.assertEqual(sorted(self._stored()), [(orbit_id, 3600) for orbit_id in sorted(towers)])
+
+    def test_failed_batch_items_are_retried(self):
+        app.config['CALENDAR_MAX_RETRIES'] = 10
+        self.calendar.error_rate = 0.3
+        towers = make_towers(CalendarServiceRun.BATCH_SIZE + 10)
+        self.assertFalse(self._run(towers).skipped)
+        stats = self.calendar.stats
+        self.assertGreater(stats['errors'], 0)
+        self.assertGreater(stats['batches'], 2)
+
+        # Each event was created exactly once, and recorded
+        events = self._events()
+        self.assertEqual(len(events), len(towers))
+        self.assertEqual(set(evt.event_id for evt in self._stored().itervalues()), set(events))
+
+    def test_failed_batches_keep_earlier_results(self):
+        towers = make_towers(CalendarServiceRun.BATCH_SIZE + 10)
+        self._serve_calendar(RejectingCalendar(seed=0))
+        self.assertRaises(RunAbortedException, self._run, towers)
+        # The first batch went through and was recorded
+        events = self._events()
+        self.assertEqual(len(events), CalendarServiceRun.BATCH_SIZE)
+        self.assertEqual(set(evt.event_id for evt in self._stored().itervalues()), set(events))
+
+        # so the next run only adds the rest
+        self.calendar.ok_batches = 1
+        self.assertFalse(self._run(towers).skipped)
+        self.assertEqual(self.calendar.stats['calls']['calendar.events.insert'], 10)
+        self.assertEqual(len(self._events()), len(towers))
+
+
+class CalendarServiceTest(FakeCalendarTestCase):
+    def setUp(self):
+        super(CalendarServiceTest, self).setUp()
+        self.service = CalendarService()
+        self.service.CLAIM_RETRY_S = 0.05
+
+    def test_reset(self):
+        towers = make_towers(3)
+        self._enable(towers)
+        self.service.run_for_char(CHAR_ID, towers).join(5)
+        self.assertEqual(len(self._events()), len(towers))
+
+        cal_id = self.service.make_calendar(CHAR_ID, Token.get_google_oauth(CHAR_ID))
+        db.session.commit()
+        self.assertNotEqual(cal_id, CAL_ID)
+        greenlet = self.service.run_for_char(CHAR_ID, towers)
+        greenlet.join(5)
+        self.assertFalse(greenlet.value.skipped)
+        self.assertEqual(len(self._events(cal_id)), len(towers))
+        self.assertEqual(set(evt.event_id for evt in self._stored().itervalues()),
+                         set(self._events(cal_id)))
+
+    def test_runs_wait_for_other_workers(self):
+        towers = make_towers(3)
+        self._enable(towers)
+        now = datetime.utcnow()
+        self.assertTrue(RunLease.claim_char(CHAR_ID, 'other', now, now + timedelta(minutes=15)))
+
+        greenlet = self.service.run_for_char(CHAR_ID, towers)
+        gevent.sleep(0.3)
+        self.assertFalse(greenlet.ready())
+        self.assertFalse(self.calendar.stats['calls'])
+
+        RunLease.release(CHAR_ID, 'other', now, now + timedelta(hours=1))
+        greenlet.join(5)
+        self.assertTrue(greenlet.successful())
+        self.assertEqual(len(self._events()), len(towers))
+
+        # The lease is handed back once the run is done
+        gevent.sleep(0.1)
+        db.session.expire_all()
+        self.assertIsNone(RunLease.query.get(CHAR_ID).owner)
+
+    def test_forced_runs_take_leases(self):
+        self._enable(make_towers(3))
+        greenlet = self.service.run_for_char(CHAR_ID, make_towers(3))
+        greenlet.join(5)
+        self.assertTrue(greenlet.successful())
+        gevent.sleep(0.1)
+        lease = RunLease.query.get(CHAR_ID)
+        self.assertIsNone(lease.owner)
+        self.assertGreater(lease.due, datetime.utcnow())
@@ -0,0 +1,111 @@
+import gevent
+from datetime import datetime, timedelta
+
+from eveposcal.app import db
+from eveposcal.model import db as db_model
+from eveposcal.model.db import CalendarEvent, RunLease, ServiceLease
+
+from . import AppTestCase
+
+NOW = datetime(2015, 1, 1)
+LEASE = timedelta(minutes=10)
+
+
+class ServiceLeaseTest(AppTestCase):
+    def test_one_holder_at_a_time(self):
+        name = ServiceLease.TOKEN_REFRESH
+        self.assertTrue(ServiceLease.acquire(name, 'a', NOW, NOW + LEASE))
+        self.assertFalse(ServiceLease.acquire(name, 'b', NOW, NOW + LEASE))
+
+        # The holder renews it, and keeps it past the original expiry
+        later = NOW + timedelta(minutes=5)
+        self.assertTrue(ServiceLease.acquire(name, 'a', later, later + LEASE))
+        self.assertFalse(ServiceLease.acquire(name, 'b', NOW + LEASE, NOW + LEASE * 2))
+
+        # Someone else takes over once it expires
+        expired = later + LEASE + timedelta(seconds=1)
+        self.assertTrue(ServiceLease.acquire(name, 'b', expired, expired + LEASE))
+        self.assertFalse(ServiceLease.acquire(name, 'a', expired, expired + LEASE))
+
+    def test_leases_are_independent(self):
+        self.assertTrue(ServiceLease.acquire('one', 'a', NOW, NOW + LEASE))
+        self.assertTrue(ServiceLease.acquire('two', 'b', NOW, NOW + LEASE))
+
+
+class RunLeaseTest(AppTestCase):
+    def setUp(self):
+        super(RunLeaseTest, self).setUp()
+        RunLease.sync_members([1, 2, 3], lambda char_id: NOW + timedelta(minutes=char_id - 2))
+
+    def _lease(self, char_id):
+        db.session.expire_all()
+        return RunLease.query.get(char_id)
+
+    def test_claim_is_exclusive(self):
+        self.assertEqual(sorted(RunLease.claim('a', NOW, NOW + LEASE, 10)), [1, 2])
+        self.assertEqual(RunLease.claim('b', NOW, NOW + LEASE, 10), [])
+        self.assertFalse(RunLease.claim_char(1, 'b', NOW, NOW + LEASE))
+
+        # Not due, but free
+        self.assertTrue(RunLease.claim_char(3, 'b', NOW, NOW + LEASE))
+        self.assertEqual(RunLease.claim('c', NOW + timedelta(minutes=5), NOW + LEASE, 10), [])
+
+        # Expired leases can be taken over
+        expired = NOW + LEASE + timedelta(seconds=1)
+        self.assertEqual(sorted(RunLease.claim('c', expired, expired + LEASE, 10)), [1, 2, 3])
+
+    def test_claim_char_adds_missing_rows(self):
+        self.assertTrue(RunLease.claim_char(4, 'a', NOW, NOW + LEASE))
+        self.assertEqual(self._lease(4).owner, 'a')
+        self.assertFalse(RunLease.claim_char(4, 'b', NOW, NOW + LEASE))
+
+    def test_release(self):
+        RunLease.claim('a', NOW, NOW + LEASE, 10)
+        RunLease.release(1, 'b', NOW, NOW + timedelta(hours=1))
+        self.assertEqual(self._lease(1).owner, 'a')
+
+        due = NOW + timedelta(hours=1)
+        RunLease.release(1, 'a', NOW, due)
+        lease = self._lease(1)
+        self.assertEqual((lease.owner, lease.expires, lease.due), (None, None, due))
+
+    def test_expedite_during_lease_survives_release(self):
+        RunLease.claim('a', NOW, NOW + LEASE, 10)
+        expedited = NOW + timedelta(minutes=1)
+        RunLease.expedite([2, 3], expedited)
+        RunLease.release(2, 'a', NOW, NOW + timedelta(hours=1))
+        self.assertEqual(self._lease(2).due, expedited)
+        self.assertEqual(self._lease(3).due, expedited)
+        self.assertEqual(RunLease.claim('b', expedited, expedited + LEASE, 10), [2, 3])
+
+
+class UpgradeSchemaTest(AppTestCase):
+    def setUp(self):
+        super(UpgradeSchemaTest, self).setUp()
+        db.engine.execute('CREATE TABLE calendar_event (char_id INTEGER, orbit_id INTEGER, '
+                          'event_id VARCHAR(256), PRIMARY KEY (char_id, orbit_id))')
+        db.engine.execute("INSERT INTO calendar_event VALUES (1, 1000, 'evt1')")
+
+    def test_legacy_events_are_migrated(self):
+        db_model.upgrade_schema()
+        self.assertEqual([(evt.orbit_id, evt.reminder_s, evt.event_id)
+                          for evt in CalendarEvent.get_for_char(1)],
+                         [(1000, CalendarEvent.LEGACY_REMINDER_S, 'evt1')])
+        self.assertFalse(db_model._has_table('calendar_event'))
+
+    def test_other_workers_wait_for_the_migration(self):
+        now = datetime.utcnow()
+        self.assertTrue(ServiceLease.acquire(ServiceLease.SCHEMA_UPGRADE, 'other', now,
+                                             now + LEASE))
+        self.addCleanup(setattr, db_model, 'SCHEMA_POLL_S', db_model.SCHEMA_POLL_S)
+        db_model.SCHEMA_POLL_S = 0.05
+
+        greenlet = gevent.spawn(db_model.upgrade_schema)
+        gevent.sleep(0.2)
+        self.assertFalse(greenlet.ready())
+
+        # The other worker finishes the migration
+        db.engine.execute('DROP TABLE calendar_event')
+        greenlet.join(5)
+        self.assertTrue(greenlet.successful())
+        self.assertEqual(CalendarEvent.get_for_char(1), [])
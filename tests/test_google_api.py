@@ -0,0 +1,53 @@
+import gevent
+import socket
+
+from bench.fakes import FakeCalendar
+from eveposcal import google_api
+from eveposcal.app import app
+
+from . import AppTestCase, make_credentials
+
+CHAR_ID = 1
+
+
+class ServiceTest(AppTestCase):
+    def setUp(self):
+        super(ServiceTest, self).setUp()
+        self.calendar = FakeCalendar(latency=0.01)
+        url = self.serve(self.calendar)
+        app.config['DISCOVERY_URI'] = url + 'discovery/v1/apis/{api}/{apiVersion}/rest'
+        self.creds = make_credentials()
+
+    def _service(self):
+        return google_api.service(CHAR_ID, self.creds, 'calendar', 'v3')
+
+    def test_services_are_reused_once_released(self):
+        with self._service() as first:
+            with self._service() as second:
+                self.assertIsNot(first._http, second._http)
+        with self._service() as third:
+            self.assertIs(third, first)
+
+        # A block that raised may have left its connection mid-request
+        with self.assertRaises(ValueError):
+            with self._service() as fourth:
+                raise ValueError()
+        with self._service() as fifth:
+            self.assertIsNot(fifth, fourth)
+
+    def test_concurrent_requests(self):
+        def _get(n):
+            with self._service() as api:
+                return api.calendars().get(calendarId='cal%d' % (n,)).execute()
+
+        _get(0)
+        jobs = [gevent.spawn(_get, n) for n in xrange(10)]
+        gevent.joinall(jobs, timeout=10, raise_error=True)
+        self.assertEqual([job.value['id'] for job in jobs], ['cal%d' % (n,) for n in xrange(10)])
+
+    def test_requests_time_out(self):
+        app.config['GOOGLE_HTTP_TIMEOUT_S'] = 0.1
+        self.calendar.latency = 5
+        with self.assertRaises(socket.timeout):
+            with self._service() as api:
+                api.calendars().get(calendarId='cal1').execute()
@@ -0,0 +1,55 @@
+from bench.fakes import ORBIT_BASE, PosmonFeed
+from eveposcal.app import app, db
+from eveposcal.controllers import auth, setup
+from eveposcal.model.db import EnabledTowers, Token
+from eveposcal.model.posmon import Tower
+
+from . import AppTestCase, make_credentials
+
+# Routes the home page links to
+auth
+
+CHAR_ID = 1
+
+
+class HomeTest(AppTestCase):
+    def setUp(self):
+        super(HomeTest, self).setUp()
+        app.config['POSMON_URL'] = self.serve(PosmonFeed(5))
+        Tower._snapshot = None
+        setup._profiles.pop(CHAR_ID)
+
+        EnabledTowers.replace_for_char(CHAR_ID, [ORBIT_BASE])
+        db.session.commit()
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session['char_id'] = CHAR_ID
+            session['char_name'] = 'Test Pilot'
+
+    def test_connected(self):
+        Token.set_google_oauth(CHAR_ID, make_credentials())
+        db.session.commit()
+        setup._profiles.set(CHAR_ID, {'displayName': 'Google Name'})
+
+        response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('connected to Google Calendar as Google Name', response.data)
+        self.assertIn('Tower 1', response.data)
+        etag = response.headers['ETag']
+
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+
+        # Enabling another tower changes the page
+        EnabledTowers.replace_for_char(CHAR_ID, [ORBIT_BASE, ORBIT_BASE + 1])
+        db.session.commit()
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_not_connected(self):
+        response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Not connected to Google Calendar', response.data)
+        self.assertIn('Tower 1', response.data)